@@ -3,62 +3,318 @@
 import os
 import json
 import logging
-from pprint import pformat
-import hashlib
+import sqlite3
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Set, Tuple
 from collections import OrderedDict
-import boto3
+import transfer
+from hashing import Digests, MultiHash, hash_file, hash_pool
+from publisher import BatchPublisher, sqs_sender, sns_sender
+from botocore.exceptions import ClientError
 
 
 logger = logging.getLogger(__name__)
 
 
-def upload_file(f_url, local_f, contentType, lastModified):
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/resources.html#multithreading-multiprocessing
-    # make boto3 S3 thread-safety
-    session = boto3.session.Session()
+def harvest_bucket() -> str:
     from config import production_phase
-    if production_phase:
-        bucketName = 'grid-linux-harvest'
-        sqs_url = 'https://sqs.us-west-2.amazonaws.com/745063655428/grid_linux_harvest'
-    else:
-        bucketName = 'grid-staging-linux'
-        topicArn = 'arn:aws:sns:us-east-1:934030439160:grid_ux_harvest_staging'
-
-    md5 = hashlib.md5()
-    sha1 = hashlib.sha1()
-    sha256 = hashlib.sha256()
-    with open(local_f, 'rb') as f:
-        while True:
-            data = f.read(1024*1024)
-            if not data:
-                break
-            md5.update(data)
-            sha1.update(data)
-            sha256.update(data)
-
-    key = sha256.hexdigest()
-    key = key[:2] + '/' + key[2:5] + '/' + key[5:8] + '/' + key
-    contentTag = contentType
-    bucket = session.resource('s3', region_name='us-east-1').Bucket(bucketName)
-    bucket.upload_file(local_f, key)
-
-    msg = OrderedDict([
-        ('bucket', bucketName), ('key', key), ('sha1', sha1.hexdigest()),
-        ('md5', md5.hexdigest()), ('sha256', sha256.hexdigest()), ('priority', 5),
-        ('source', f_url), ('contentTag', contentTag), ('lastModified', lastModified),
-        ('filename', os.path.basename(local_f)),
+    return 'grid-linux-harvest' if production_phase else 'grid-staging-linux'
+
+
+def guen_keyname(key: str) -> str:
+    return key[:2] + '/' + key[2:5] + '/' + key[5:8] + '/' + key
+
+
+def existing_keys(bucketName: str, sha256s: Iterable[str], workers: int = 16) -> Set[str]:
+    """
+    return the subset of sha256s already stored in bucketName.
+    HEAD requests are issued in parallel, one per object.
+    """
+    client = transfer.client('s3', region_name='us-east-1')
+
+    def exists(sha256: str) -> bool:
+        try:
+            client.head_object(Bucket=bucketName, Key=guen_keyname(sha256))
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    sha256s = list(sha256s)
+    if not sha256s:
+        return set()
+    with ThreadPoolExecutor(min(workers, len(sha256s))) as pool:
+        found = pool.map(exists, sha256s)
+    return {sha256 for sha256, ok in zip(sha256s, found) if ok}
+
+
+class DedupIndex(object):
+    """
+    persistent map (source URL, Last-Modified, Content-Length) -> sha256, plus the set of
+    sha256 objects known to be in the bucket.
+    Lets the harvesters skip a download when the response headers already identify
+    an object we hold, and skip upload/announcement for content mirrored under another URL.
+    """
+
+    def __init__(self, path: str, bucketName: str):
+        self.bucketName = bucketName
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS dedup_index ('
+                ' url TEXT, last_modified TEXT, content_length INTEGER, sha256 TEXT,'
+                ' PRIMARY KEY (url, last_modified, content_length))')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS stored_objects ('
+                ' bucket TEXT, sha256 TEXT, PRIMARY KEY (bucket, sha256))')
+            # announcements staged before their object is written, deleted once sent
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS outbox ('
+                ' bucket TEXT, sha256 TEXT, msg TEXT, PRIMARY KEY (bucket, sha256))')
+
+    def lookup(self, url: str, last_modified: Optional[str], content_length: Optional[int]) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT sha256 FROM dedup_index WHERE url=? AND last_modified IS ? AND content_length IS ?',
+                (url, last_modified, content_length)).fetchone()
+        return row[0] if row else None
+
+    def record(self, url: str, last_modified: Optional[str], content_length: Optional[int], sha256: str) -> None:
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO dedup_index VALUES (?, ?, ?, ?)',
+                              (url, last_modified, content_length, sha256))
+
+    def mark_stored(self, sha256s: Iterable[str]) -> None:
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO stored_objects VALUES (?, ?)',
+                                  [(self.bucketName, _) for _ in sha256s])
+
+    def stage_announcement(self, sha256: str, msg: str) -> None:
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO outbox VALUES (?, ?, ?)', (self.bucketName, sha256, msg))
+
+    def announced(self, sha256: str) -> None:
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM outbox WHERE bucket=? AND sha256=?', (self.bucketName, sha256))
+
+    def unannounced(self) -> List[Tuple[str, str]]:
+        """
+        (sha256, message) of the announcements staged but not sent
+        """
+        with self.lock:
+            return self.conn.execute('SELECT sha256, msg FROM outbox WHERE bucket=?',
+                                     (self.bucketName,)).fetchall()
+
+    def stored(self, sha256s: Iterable[str]) -> Set[str]:
+        """
+        batch existence check: answered from the local table when possible,
+        the remaining hashes are checked against the bucket in one parallel batch.
+        """
+        sha256s = set(sha256s)
+        if not sha256s:
+            return set()
+        with self.lock:
+            known = set()
+            for sha256 in sha256s:
+                if self.conn.execute('SELECT 1 FROM stored_objects WHERE bucket=? AND sha256=?',
+                                     (self.bucketName, sha256)).fetchone():
+                    known.add(sha256)
+        unknown = sha256s - known
+        if unknown:
+            found = existing_keys(self.bucketName, unknown)
+            self.mark_stored(found)
+            known |= found
+        return known
+
+
+_dedup_index = None
+_dedup_lock = threading.Lock()
+
+
+def dedup_index() -> DedupIndex:
+    """
+    process-wide index; opening it resends the announcements an earlier run left unsent
+    """
+    global _dedup_index
+    created = False
+    with _dedup_lock:
+        if _dedup_index is None:
+            from config import manifest_db
+            _dedup_index = DedupIndex(manifest_db, harvest_bucket())
+            created = True
+        index = _dedup_index
+    if created:
+        resend_announcements(index)
+    return index
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def harvest_publisher() -> BatchPublisher:
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            from config import production_phase
+            if production_phase:
+                sqs_url = 'https://sqs.us-west-2.amazonaws.com/745063655428/grid_linux_harvest'
+                _publisher = BatchPublisher(sqs_sender(sqs_url, 'us-west-2'))
+            else:
+                topicArn = 'arn:aws:sns:us-east-1:934030439160:grid_ux_harvest_staging'
+                _publisher = BatchPublisher(sns_sender(topicArn, 'us-east-1'))
+        return _publisher
+
+
+def announce(index: DedupIndex, sha256: str, msg: str) -> None:
+    """
+    publish the staged announcement of sha256 without waiting for it; its outbox entry is
+    removed once it is sent, and kept for resend_announcements() if it is given up
+    """
+    def sent(future) -> None:
+        if future.exception() is None:
+            index.announced(sha256)
+        else:
+            logger.warning('announcement of %s left for the next run: %r' % (sha256, future.exception()))
+    harvest_publisher().publish(msg).add_done_callback(sent)
+
+
+def resend_announcements(index: DedupIndex) -> None:
+    """
+    announce the objects whose announcement was staged but never sent (given up, or the
+    process died); entries for objects that never reached the bucket are dropped
+    """
+    pending = dict(index.unannounced())
+    if not pending:
+        return
+    found = existing_keys(index.bucketName, pending)
+    logger.info('resend %d announcements' % len(found))
+    for sha256, msg in pending.items():
+        if sha256 in found:
+            announce(index, sha256, msg)
+        else:
+            index.announced(sha256)
+
+
+def harvest_msg(bucketName, key, digests: Digests, f_url, contentType, lastModified, filename) -> OrderedDict:
+    return OrderedDict([
+        ('bucket', bucketName), ('key', key), ('sha1', digests.sha1),
+        ('md5', digests.md5), ('sha256', digests.sha256), ('priority', 5),
+        ('source', f_url), ('contentTag', contentType), ('lastModified', lastModified),
+        ('filename', filename),
         ("sourceCategory", "InternalPartner/GRID-UX"),
         ('jobRegistryId', 'na')])
 
-    response = None
-    if production_phase:
-        client = session.client('sqs', region_name='us-west-2')
-        response = client.send_message(QueueUrl=sqs_url, MessageBody=json.dumps(msg))
-    else:
-        client = session.client('sns', region_name='us-east-1')
-        response = client.publish(TopicArn=topicArn, Message=json.dumps(msg))
-    response_code = response['ResponseMetadata']['HTTPStatusCode']
-    if response_code == 200:
-        pass
+
+def upload_file(f_url, local_f, contentType, lastModified) -> Optional[str]:
+    bucketName = harvest_bucket()
+
+    # on the hashing pool: download threads wait here instead of all hashing at once
+    digests = hash_pool().submit(hash_file, local_f).result()
+
+    index = dedup_index()
+    index.record(f_url, lastModified, os.path.getsize(local_f), digests.sha256)
+    if index.stored([digests.sha256]):
+        logger.info('already stored, skip upload %s' % f_url)
+        return digests.sha256
+
+    key = guen_keyname(digests.sha256)
+    msg = json.dumps(harvest_msg(bucketName, key, digests, f_url, contentType, lastModified,
+                                 os.path.basename(local_f)))
+    # staged first: once the object is in the bucket, the announcement survives a crash
+    index.stage_announcement(digests.sha256, msg)
+    transfer.upload_file(local_f, bucketName, key, region_name='us-east-1')
+    index.mark_stored([digests.sha256])
+    announce(index, digests.sha256, msg)
+    return digests.sha256
+
+
+def upload_stream(f_url, stream, filename, contentType, lastModified,
+                  part_size: int = 16 * 1024 * 1024, max_inflight_parts: int = 4) -> Optional[str]:
+    """
+    upload a file straight from a download stream, without a local copy.
+    md5/sha1/sha256 are updated as parts are read, while earlier parts are already being uploaded
+    to a temporary key; the object is then server-side copied to its sha256 key.
+    Files smaller than part_size are buffered and PUT directly to their final key.
+    :param stream: file-like object with read(n), e.g. requests' Response.raw
+    """
+    bucketName = harvest_bucket()
+    client = transfer.client('s3', region_name='us-east-1')
+    index = dedup_index()
+
+    h = MultiHash()
+
+    def read_part() -> bytes:
+        chunks = []
+        remain = part_size
+        while remain > 0:
+            data = stream.read(min(remain, 1024 * 1024))
+            if not data:
+                break
+            h.update(data)
+            chunks.append(data)
+            remain -= len(data)
+        return b''.join(chunks)
+
+    part = read_part()
+    size = len(part)
+    if size < part_size:
+        key = guen_keyname(h.sha256.hexdigest())
+        index.record(f_url, lastModified, size, h.sha256.hexdigest())
+        if index.stored([h.sha256.hexdigest()]):
+            logger.info('already stored, skip upload %s' % f_url)
+            return h.sha256.hexdigest()
+        msg = json.dumps(harvest_msg(bucketName, key, h.digests(), f_url, contentType, lastModified, filename))
+        index.stage_announcement(h.sha256.hexdigest(), msg)
+        client.put_object(Bucket=bucketName, Key=key, Body=part)
     else:
-        logger.warning('Upload failed, response= %s' % pformat(response))
+        tmp_key = '_incoming/' + uuid.uuid4().hex
+        mpu = client.create_multipart_upload(Bucket=bucketName, Key=tmp_key)
+        inflight = threading.BoundedSemaphore(max_inflight_parts)
+
+        def upload_part(part_no: int, body: bytes) -> dict:
+            try:
+                resp = client.upload_part(Bucket=bucketName, Key=tmp_key, UploadId=mpu['UploadId'],
+                                          PartNumber=part_no, Body=body)
+                return {'PartNumber': part_no, 'ETag': resp['ETag']}
+            finally:
+                inflight.release()
+
+        try:
+            futures = []
+            with ThreadPoolExecutor(max_inflight_parts) as pool:
+                part_no = 1
+                while part:
+                    inflight.acquire()
+                    futures.append(pool.submit(upload_part, part_no, part))
+                    part_no += 1
+                    part = read_part()
+                    size += len(part)
+                parts = [f.result() for f in futures]
+            client.complete_multipart_upload(Bucket=bucketName, Key=tmp_key, UploadId=mpu['UploadId'],
+                                             MultipartUpload={'Parts': parts})
+        except BaseException:
+            client.abort_multipart_upload(Bucket=bucketName, Key=tmp_key, UploadId=mpu['UploadId'])
+            raise
+
+        key = guen_keyname(h.sha256.hexdigest())
+        index.record(f_url, lastModified, size, h.sha256.hexdigest())
+        try:
+            if index.stored([h.sha256.hexdigest()]):
+                logger.info('already stored, skip upload %s' % f_url)
+                return h.sha256.hexdigest()
+            msg = json.dumps(harvest_msg(bucketName, key, h.digests(), f_url, contentType, lastModified, filename))
+            index.stage_announcement(h.sha256.hexdigest(), msg)
+            client.copy({'Bucket': bucketName, 'Key': tmp_key}, bucketName, key,
+                        Config=transfer.transfer_config(size))
+        finally:
+            client.delete_object(Bucket=bucketName, Key=tmp_key)
+
+    index.mark_stored([h.sha256.hexdigest()])
+    announce(index, h.sha256.hexdigest(), msg)
+    return h.sha256.hexdigest()
@@ -3,8 +3,9 @@
 import re
 import os
 import urllib
-from pyquery import PyQuery as pq
 from boto3x import upload_file
+from crawler import iter_files
+from resume_download import DownloadError, http_download
 
 
 def repo_to_regex(repo):
@@ -17,64 +18,26 @@ def repo_to_regex(repo):
     return r
 
 
-def recursion(url):
-    import time
-    for try_count in range(100):
-        try:
-            d = pq(url=url)
-            break
-        except Exception as ex:
-            print('try_count=', try_count, ' for url=', url)
-            if try_count == 99:
-                print(ex)
-                print('Failed to visit ', url)
-                return
-            time.sleep(0.1)
-
-    try:
-        items = d('table:nth-child(6) tr td a')
-    except Exception as ex:
-        print(ex)
-        print('no CSS selector in pyquery d')
-        return
-    for item in items[1:]:
-        if not item.text:
-            continue
-        item_url = d.base_url + item.attrib['href']
-        if item_url.endswith('/'):
-            yield from recursion(item_url)
-        else:
-            yield item_url
-
-
 dl_dir = 'downloads'
 
 
 def download_file(f_url):
-    import requests
-    import shutil
     from os.path import basename, join
     local_f = join(dl_dir, basename(urllib.parse.urlparse(f_url).path))
-    for _try in range(60):
-        try:
-            r = requests.get(f_url, stream=True, timeout=60)
-            lastModified = r.headers['Last-Modified']
-            contentType = r.headers['Content-Type']
-            with open(local_f, mode='wb') as f:
-                shutil.copyfileobj(r.raw, f)
-            try:
-                print('upload', basename(local_f))
-                upload_file(f_url, local_f, contentType, lastModified)
-            except Exception as ex:
-                print('upload "%s" failed %s' % (local_f, ex))
-            try:
-                os.remove(local_f)
-            except:
-                pass
-            return
-        except:
-            pass
-    print('download failed: ', f_url)
+    try:
+        headers = http_download(f_url, local_f)
+    except DownloadError as ex:
+        print('download failed: ', ex)
+        return
+    try:
+        print('upload', basename(local_f))
+        upload_file(f_url, local_f, headers.get('Content-Type'), headers.get('Last-Modified'))
+    except Exception as ex:
+        print('upload "%s" failed %s' % (local_f, ex))
+    try:
+        os.remove(local_f)
+    except:
+        pass
 
 
 def main():
@@ -97,7 +60,7 @@ def main():
         with open('centos_items.txt', 'w') as f:
             reporegexs = [_ for _ in repos if _.startswith(repo)]
             reporegexs = [repo_to_regex(_) for _ in reporegexs]
-            for f_url in recursion(repo):
+            for f_url in iter_files([repo]):
                 if any(re.match(_, f_url) for _ in reporegexs):
                     f.write(f_url + '\n')
                     print('download ', f_url)
@@ -1 +1,48 @@
+import os
 production_phase = False
+manifest_db = 'harvest_manifest.sqlite3'
+crawl_concurrency = 32
+crawl_per_host = 8
+streaming_upload = True
+s3_max_pool_connections = 50
+repodata_mode = True
+stream_children = True
+child_spool_bytes = 64 * 1024 * 1024
+hash_workers = os.cpu_count()
+upload_workers = 16
+upload_inflight_bytes = 256 * 1024 * 1024
+sqs_wait_seconds = 20
+sqs_visibility_timeout = 600
+sqs_heartbeat_interval = 120
+# a message whose S3 object failed to download comes back after this many seconds,
+# doubling with each receive up to sqs_max_retry_delay
+sqs_retry_delay = 30
+sqs_max_retry_delay = 3600
+decompress_workers = os.cpu_count()
+parallel_decompress_min = 64 * 1024 * 1024
+nested_max_depth = 3
+nested_max_ratio = 200
+nested_max_bytes = 50 * 1024 * 1024 * 1024
+nested_workers = os.cpu_count()
+ftp_connections = 4
+ftp_listing_db = 'ftp_listing.sqlite3'
+download_retries = 10
+segmented_min = 256 * 1024 * 1024
+segment_bytes = 32 * 1024 * 1024
+download_segments = 8
+download_workers = 16
+download_queue_items = 1000
+download_queue_bytes = 4 * 1024 * 1024 * 1024
+download_default_bytes = 16 * 1024 * 1024
+schedule_db = 'repo_schedule.sqlite3'
+refresh_min_interval = 600
+refresh_max_interval = 7 * 24 * 3600
+refresh_initial_interval = 3600
+refresh_concurrency = 4
+host_rate = 10.0
+host_burst = 20
+host_initial_limit = 4
+host_max_limit = 32
+host_failure_threshold = 5
+host_open_seconds = 60
+host_max_wait = 30
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import asyncio
+import logging
+import queue
+import threading
+from urllib.parse import urljoin
+from typing import AsyncIterator, Iterable, Iterator, List, Optional
+import aiohttp
+import lxml.etree
+import lxml.html
+from host_governor import HostUnavailable, host_governor, host_of
+
+logger = logging.getLogger(__name__)
+
+_done = object()
+
+
+def parse_listing(base_url: str, text: str) -> List[str]:
+    """
+    extract child entries from an Apache/nginx autoindex page.
+    Only links below base_url are kept, which drops the parent directory link,
+    column sort links (?C=N;O=D) and absolute links to other sites.
+    """
+    try:
+        doc = lxml.html.fromstring(text)
+    except (lxml.etree.ParserError, ValueError):
+        return []
+    children = []
+    seen = set()
+    for href in doc.xpath('//a/@href'):
+        if '?' in href or '#' in href:
+            continue
+        child = urljoin(base_url, href)
+        if not child.startswith(base_url) or child == base_url or child in seen:
+            continue
+        seen.add(child)
+        children.append(child)
+    return children
+
+
+class Crawler(object):
+    """
+    asyncio autoindex crawler.
+    `concurrency` listing pages are fetched at once over one pooled aiohttp session,
+    with at most `per_host` of them against the same mirror.
+    The frontier is a LIFO queue so it is walked depth-first and stays small;
+    discovered files go through a bounded queue so the crawl cannot run ahead of the consumer.
+    """
+
+    def __init__(self, concurrency: int = 32, per_host: int = 8, queue_size: int = 1000,
+                 timeout: int = 60, retries: int = 3):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.retries = retries
+
+    async def fetch_listing(self, session: aiohttp.ClientSession, url: str) -> Optional[str]:
+        errors = (aiohttp.ClientError, asyncio.TimeoutError)
+        for try_count in range(self.retries):
+            try:
+                async with host_governor().request(host_of(url), errors) as call:
+                    async with session.get(url) as resp:
+                        call.response(resp.status, resp.headers.get('Retry-After'))
+                        if resp.status in (429, 503):
+                            raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status)
+                        if resp.status != 200:
+                            logger.info("Failed to visit %s  status: %d" % (url, resp.status))
+                            return None
+                        return await resp.text(errors='replace')
+            except HostUnavailable as e:
+                logger.warning('Failed to visit %s %s' % (url, e))
+                return None
+            except errors as e:
+                logger.info('try_count=%d for url=%s %r' % (try_count, url, e))
+                await asyncio.sleep(0.5 * 2 ** try_count)
+        logger.warning('Failed to visit ' + url)
+        return None
+
+    async def files(self, roots: Iterable[str]) -> AsyncIterator[str]:
+        frontier = asyncio.LifoQueue()
+        found = asyncio.Queue(self.queue_size)
+        visited = set()
+        for root in roots:
+            if root not in visited:
+                visited.add(root)
+                frontier.put_nowait(root)
+
+        async def worker(session: aiohttp.ClientSession):
+            while True:
+                url = await frontier.get()
+                try:
+                    logger.info('Visit ' + url)
+                    text = await self.fetch_listing(session, url)
+                    if text is None:
+                        continue
+                    for child in parse_listing(url, text):
+                        if child.endswith('/'):
+                            if child not in visited:
+                                visited.add(child)
+                                frontier.put_nowait(child)
+                        else:
+                            await found.put(child)
+                finally:
+                    frontier.task_done()
+
+        async def supervisor(workers: list):
+            await frontier.join()
+            for w in workers:
+                w.cancel()
+            await found.put(_done)
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host, ssl=False)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            workers = [asyncio.ensure_future(worker(session)) for _ in range(self.concurrency)]
+            sup = asyncio.ensure_future(supervisor(workers))
+            try:
+                while True:
+                    f_url = await found.get()
+                    if f_url is _done:
+                        break
+                    yield f_url
+            finally:
+                sup.cancel()
+                for w in workers:
+                    w.cancel()
+                await asyncio.gather(sup, *workers, return_exceptions=True)
+
+
+def iter_files(roots: Iterable[str], **kwargs) -> Iterator[str]:
+    """
+    blocking wrapper around Crawler.files() for the synchronous harvesters.
+    The event loop runs in a background thread.
+    """
+    crawler = Crawler(**kwargs)
+    out = queue.Queue(crawler.queue_size)
+    roots = list(roots)
+
+    def run():
+        loop = asyncio.new_event_loop()
+        try:
+            async def pump():
+                async for f_url in crawler.files(roots):
+                    await loop.run_in_executor(None, out.put, f_url)
+            loop.run_until_complete(pump())
+        except Exception as e:
+            logger.warning('crawler stopped: %r' % e)
+        finally:
+            out.put(_done)
+            loop.close()
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    while True:
+        f_url = out.get()
+        if f_url is _done:
+            break
+        yield f_url
+    t.join()
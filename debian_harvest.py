@@ -1,79 +1,80 @@
 #!/usr/bin/env python3
 # coding: utf-8
 import os
+import sys
 import urllib
-from pyquery import PyQuery as pq
-from boto3x import upload_file
-
-
-def recursion(url):
-    for try_count in range(100):
-        try:
-            d = pq(url=url)
-            break
-        except Exception as ex:
-            print('try_count=', try_count, ' for url=', url)
-            if try_count == 99:
-                print(ex)
-                print('Failed to visit ', url)
-                return
-            import time
-            time.sleep(0.1)
-
-    try:
-        items = d('a')
-    except Exception as ex:
-        print(ex)
-        print('no CSS selector in pyquery d')
-        return
-    start = False
-    for item in items:
-        if item.text == 'Parent Directory' or item.text == '../':
-            start = True
-            continue
-        if not start:
-            continue
-        item_url = d.base_url + item.attrib['href']
-        if item_url.endswith('.deb'):
-            yield item_url
-        elif item_url.endswith('/'):
-            yield from recursion(item_url)
+from boto3x import upload_file, dedup_index
+from crawler import iter_files
+from resume_download import DownloadError, http_download
+from debian_index import DebianIndex
+from config import manifest_db
 
 
 dl_dir = 'downloads'
 harvest_url = 'http://ftp.us.debian.org/debian/pool/'
+mirror_url = 'http://ftp.us.debian.org/debian/'
 
 
 def download_file(f_url):
-    import requests
-    import shutil
     from os.path import basename, join
     local_f = join(dl_dir, basename(urllib.parse.urlparse(f_url).path))
-    for _try in range(60):
-        try:
-            r = requests.get(f_url, stream=True, timeout=60)
-            lastModified = r.headers['Last-Modified']
-            contentType = r.headers['Content-Type']
-            with open(local_f, mode='wb') as f:
-                shutil.copyfileobj(r.raw, f)
-            try:
-                print('upload', basename(local_f))
-                upload_file(f_url, local_f, contentType, lastModified)
-            except Exception as ex:
-                print('upload "%s" failed %s' % (local_f, ex))
-            try:
-                os.remove(local_f)
-            except:
-                pass
-            return
-        except:
-            pass
-    print('download failed: ', f_url)
+    try:
+        headers = http_download(f_url, local_f)
+    except DownloadError as ex:
+        print('download failed: ', ex)
+        return False
+    uploaded = False
+    try:
+        print('upload', basename(local_f))
+        upload_file(f_url, local_f, headers.get('Content-Type'), headers.get('Last-Modified'))
+        uploaded = True
+    except Exception as ex:
+        print('upload "%s" failed %s' % (local_f, ex))
+    try:
+        os.remove(local_f)
+    except:
+        pass
+    # a failed upload leaves the package unseen, so the next run fetches it again
+    return uploaded
+
+
+def harvest_batch(index, pkgs):
+    stored = dedup_index().stored(_.sha256 for _ in pkgs if _.sha256)
+    done = []
+    for pkg in pkgs:
+        if pkg.sha256 in stored:
+            done.append(pkg)
+            continue
+        print('download ', pkg.url)
+        if download_file(pkg.url):
+            done.append(pkg)
+    index.mark_seen(done)
+    return len(done) == len(pkgs)
+
+
+def harvest_indices():
+    index = DebianIndex(mirror_url, manifest_db)
+    for index_url, sha256 in index.changed_indices():
+        print('index ', index_url)
+        complete = True
+        batch = []
+        for pkg in index.new_packages(index_url):
+            batch.append(pkg)
+            if len(batch) >= 500:
+                complete &= harvest_batch(index, batch)
+                batch = []
+        complete &= harvest_batch(index, batch)
+        if complete:
+            index.mark_done(index_url, sha256)
 
 
 def main():
     os.makedirs(dl_dir, exist_ok=True)
-    for line_num, f_url in enumerate(recursion(harvest_url)):
+    if '--crawl' not in sys.argv:
+        harvest_indices()
+        return
+    deb_urls = (_ for _ in iter_files([harvest_url]) if _.endswith('.deb'))
+    for line_num, f_url in enumerate(deb_urls):
         print('%d download ' % line_num, f_url)
         download_file(f_url)
 
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import io
+import re
+import gzip
+import hashlib
+import lzma
+import sqlite3
+import threading
+import logging
+from collections import namedtuple
+from urllib.parse import urljoin
+from typing import Dict, Iterable, Iterator, List, Tuple
+import requests
+from crawler import parse_listing
+
+logger = logging.getLogger(__name__)
+
+DebPackage = namedtuple('DebPackage', ['url', 'filename', 'size', 'sha256'])
+
+packages_index_regex = re.compile(r'^[^/]+/binary-[^/]+/Packages\.(xz|gz)$')
+
+
+def parse_release(text: str) -> Dict[str, Tuple[str, int]]:
+    """
+    SHA256 section of a Release file: {path: (sha256, size)}
+    """
+    files = {}
+    in_sha256 = False
+    for line in text.splitlines():
+        if not line.startswith(' '):
+            in_sha256 = line.startswith('SHA256:')
+            continue
+        if in_sha256:
+            sha256, size, path = line.split()
+            files[path] = (sha256, int(size))
+    return files
+
+
+def iter_stanzas(lines: Iterable[str]) -> Iterator[Dict[str, str]]:
+    """
+    RFC822-like paragraphs of a Packages index; continuation lines are dropped
+    because none of the fields we use span lines
+    """
+    stanza = {}
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line:
+            if stanza:
+                yield stanza
+                stanza = {}
+            continue
+        if line[0] in ' \t':
+            continue
+        field, _, value = line.partition(':')
+        stanza[field] = value.strip()
+    if stanza:
+        yield stanza
+
+
+class DebianIndex(object):
+    """
+    enumerates .deb files of a Debian mirror from dists/*/Release and the Packages.xz/.gz indices
+    instead of crawling pool/.
+    The sha256 of every Release and Packages index is remembered between runs, so an unchanged
+    suite costs one request and an unchanged index none; of a changed index only packages
+    not seen before are returned.
+    """
+
+    def __init__(self, mirror: str, db_path: str, timeout: int = 60):
+        self.mirror = mirror
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS debian_index ('
+                ' url TEXT PRIMARY KEY, sha256 TEXT)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS debian_seen ('
+                ' filename TEXT PRIMARY KEY, sha256 TEXT)')
+
+    def _get(self, url: str) -> requests.Response:
+        r = requests.get(url, timeout=self.timeout)
+        r.raise_for_status()
+        return r
+
+    def _known(self, url: str) -> str:
+        with self.lock:
+            row = self.conn.execute('SELECT sha256 FROM debian_index WHERE url=?', (url,)).fetchone()
+        return row[0] if row else None
+
+    def mark_done(self, url: str, sha256: str) -> None:
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO debian_index VALUES (?, ?)', (url, sha256))
+
+    def mark_seen(self, pkgs: Iterable[DebPackage]) -> None:
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO debian_seen VALUES (?, ?)',
+                                  [(_.filename, _.sha256) for _ in pkgs])
+
+    def suites(self) -> List[str]:
+        dists = urljoin(self.mirror, 'dists/')
+        return [_ for _ in parse_listing(dists, self._get(dists).text) if _.endswith('/')]
+
+    def changed_indices(self) -> Iterator[Tuple[str, str]]:
+        """
+        (Packages index URL, its sha256 from Release) for every index that changed since
+        it was last marked done; call mark_done(url, sha256) once an index has been harvested.
+        Suites whose Release did not change are skipped entirely.
+        """
+        seen = set()
+        for suite in self.suites():
+            release_url = urljoin(suite, 'Release')
+            try:
+                release = self._get(release_url).content
+            except requests.RequestException as e:
+                logger.info('Failed to fetch %s %r' % (release_url, e))
+                continue
+            release_sha256 = hashlib.sha256(release).hexdigest()
+            # stable/testing/... are symlinks to codename directories
+            if release_sha256 in seen:
+                continue
+            seen.add(release_sha256)
+            if self._known(release_url) == release_sha256:
+                logger.info('unchanged ' + release_url)
+                continue
+            files = parse_release(release.decode('utf-8', 'replace'))
+            indices = {}
+            for path in sorted(files):
+                m = packages_index_regex.match(path)
+                if not m:
+                    continue
+                stem = path[:-len(m.group(1))]
+                # prefer .xz over .gz for the same index
+                if stem not in indices or m.group(1) == 'xz':
+                    indices[stem] = path
+            pending = [(urljoin(suite, path), files[path][0]) for path in sorted(indices.values())]
+            for url, sha256 in pending:
+                if self._known(url) != sha256:
+                    yield url, sha256
+            # only skip this Release next time if the caller got through every index
+            if all(self._known(url) == sha256 for url, sha256 in pending):
+                self.mark_done(release_url, release_sha256)
+
+    def packages(self, index_url: str) -> Iterator[DebPackage]:
+        """
+        stream-decompress and parse a Packages index
+        """
+        with requests.get(index_url, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            if index_url.endswith('.xz'):
+                stream = lzma.LZMAFile(r.raw)
+            else:
+                stream = gzip.GzipFile(fileobj=r.raw)
+            for stanza in iter_stanzas(io.TextIOWrapper(stream, encoding='utf-8', errors='replace')):
+                if 'Filename' not in stanza:
+                    continue
+                yield DebPackage(url=urljoin(self.mirror, stanza['Filename']), filename=stanza['Filename'],
+                                 size=int(stanza['Size']) if 'Size' in stanza else None,
+                                 sha256=stanza.get('SHA256'))
+
+    def new_packages(self, index_url: str) -> Iterator[DebPackage]:
+        """
+        packages of an index that were not marked seen with the same sha256
+        """
+        for pkg in self.packages(index_url):
+            with self.lock:
+                row = self.conn.execute('SELECT sha256 FROM debian_seen WHERE filename=?',
+                                        (pkg.filename,)).fetchone()
+            if row and row[0] == pkg.sha256:
+                continue
+            yield pkg
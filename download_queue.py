@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import queue
+import threading
+import logging
+import traceback
+from typing import Any, Callable, Optional
+from upload_stage import ByteBudget
+from host_governor import HostBusy, HostUnavailable
+
+logger = logging.getLogger(__name__)
+
+_stop = object()
+
+
+class DownloadQueue(object):
+    """
+    bounded hand-off from the crawl to a fixed set of download threads. At most `max_items`
+    items wait in the queue and at most `max_bytes` expected bytes are queued or being
+    downloaded; put() blocks the producer when either limit is reached, offer() returns False.
+    An item of unknown size is counted as `default_size` bytes.
+    """
+
+    def __init__(self, handler: Callable[[Any], Any], workers: int, max_items: int, max_bytes: int,
+                 default_size: int):
+        self.handler = handler
+        self.default_size = default_size
+        self.items = queue.Queue(max_items)
+        self.budget = ByteBudget(max_bytes)
+        self.threads = [threading.Thread(target=self.run, name='download-%d' % i, daemon=True)
+                        for i in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    def put(self, item: Any, size: Optional[int] = None) -> None:
+        size = size or self.default_size
+        self.budget.acquire(size)
+        self.items.put((item, size))
+
+    def offer(self, item: Any, size: Optional[int] = None) -> bool:
+        size = size or self.default_size
+        if not self.budget.try_acquire(size):
+            return False
+        try:
+            self.items.put_nowait((item, size))
+        except queue.Full:
+            self.budget.release(size)
+            return False
+        return True
+
+    def run(self) -> None:
+        while True:
+            entry = self.items.get()
+            if entry is _stop:
+                break
+            item, size = entry
+            try:
+                self.handler(item)
+            except HostBusy as e:
+                # the host is at its limit: go to the back of the queue and serve other hosts meanwhile
+                try:
+                    self.items.put_nowait(entry)
+                    continue
+                except queue.Full:
+                    logger.info('skip %s: %s' % (item, e))
+            except HostUnavailable as e:
+                logger.info('skip %s: %s' % (item, e))
+            except Exception as e:
+                logger.warning('download %s failed %s' % (item, e))
+                logger.warning(traceback.format_exc())
+            finally:
+                self.items.task_done()
+            self.budget.release(size)
+
+    def close(self) -> None:
+        """
+        wait until every queued item is handled, then stop the threads
+        """
+        self.items.join()
+        for _ in self.threads:
+            self.items.put(_stop)
+        for t in self.threads:
+            t.join()
+
+
+def download_queue(handler: Callable[[Any], Any]) -> DownloadQueue:
+    """
+    DownloadQueue sized from config: download_workers I/O threads; hashing of the
+    downloaded files runs separately on config.hash_workers
+    """
+    from config import download_workers, download_queue_items, download_queue_bytes, download_default_bytes
+    return DownloadQueue(handler, download_workers, download_queue_items, download_queue_bytes,
+                         download_default_bytes)
@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import os
+import bz2
+import gzip
+import lzma
+import tarfile
+import zipfile
+import zlib
+import logging
+import threading
+from contextlib import closing, contextmanager
+from os.path import basename, splitext, join as pjoin
+from typing import BinaryIO, Iterator, Optional, Tuple
+from rpm_reader import RPM_MAGIC, RpmError, iter_cpio, open_payload
+from parallel_decompress import ReadaheadReader, large_input, parallel_stream
+
+logger = logging.getLogger(__name__)
+
+# (format, magic, offset)
+COMPRESSION_MAGIC = [
+    ('gzip', b'\x1f\x8b', 0),
+    ('bzip2', b'BZh', 0),
+    ('xz', b'\xfd7zXZ\x00', 0),
+    ('zstd', b'\x28\xb5\x2f\xfd', 0),
+    ('lzma', b'\x5d\x00\x00', 0),
+]
+AR_MAGIC = b'!<arch>\n'
+ZIP_MAGIC = b'PK\x03\x04'
+
+
+class ExtractError(Exception):
+    pass
+
+
+class UnsupportedMember(ExtractError):
+    """
+    a zip member zipfile cannot decode: a method such as Deflate64, or encryption
+    """
+    pass
+
+
+# what a corrupt or unsupported archive raises while it is read. Environment errors
+# (ENOSPC, EACCES, EMFILE, ...) are not among them: they must fail the job, not the archive.
+EXTRACT_ERRORS = (ExtractError, RpmError, tarfile.TarError, zipfile.BadZipFile, EOFError,
+                  lzma.LZMAError, zlib.error)
+
+
+_budget = threading.local()
+
+
+@contextmanager
+def write_budget(max_bytes: int):
+    """
+    in-process extraction on this thread raises ExtractError once it has written more than
+    max_bytes, instead of filling the disk
+    """
+    _budget.remain = max_bytes
+    try:
+        yield
+    finally:
+        _budget.remain = None
+
+
+def copy_out(fileobj, fout) -> None:
+    """
+    shutil.copyfileobj() charged against the write_budget() of this thread, if any
+    """
+    while True:
+        data = fileobj.read(1024 * 1024)
+        if not data:
+            return
+        remain = getattr(_budget, 'remain', None)
+        if remain is not None:
+            if len(data) > remain:
+                raise ExtractError('extraction exceeds its byte budget')
+            _budget.remain = remain - len(data)
+        fout.write(data)
+
+
+class CheckedReader(object):
+    """
+    decompressed stream whose corrupt-data errors are raised as ExtractError: gzip and bz2
+    report them as an OSError without an errno, which is told apart from a failing disk
+    """
+
+    def __init__(self, stream, errors: tuple = ()):
+        self.stream = stream
+        self.errors = errors
+
+    def read(self, n: int = -1) -> bytes:
+        try:
+            return self.stream.read(n)
+        except OSError as e:
+            if e.errno is not None:
+                raise
+            raise ExtractError(str(e)) from e
+        except self.errors as e:
+            raise ExtractError(str(e)) from e
+
+    def close(self) -> None:
+        self.stream.close()
+
+
+class PrefixedReader(object):
+    """
+    file-like object that replays bytes already read from a stream before the rest of it,
+    so a header can be sniffed without decoding the stream twice
+    """
+
+    def __init__(self, prefix: bytes, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, n: int = -1) -> bytes:
+        if self.prefix:
+            if n is None or n < 0:
+                data, self.prefix = self.prefix + self.stream.read(), b''
+                return data
+            data, self.prefix = self.prefix[:n], self.prefix[n:]
+            if len(data) < n:
+                data += self.stream.read(n - len(data))
+            return data
+        return self.stream.read(n)
+
+
+class LimitedReader(object):
+    """
+    read at most `size` bytes of a stream, used for ar members
+    """
+
+    def __init__(self, stream, size: int):
+        self.stream = stream
+        self.remain = size
+
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0 or n > self.remain:
+            n = self.remain
+        data = self.stream.read(n)
+        self.remain -= len(data)
+        return data
+
+
+def sniff_compression(head: bytes) -> Optional[str]:
+    for name, magic, offset in COMPRESSION_MAGIC:
+        if head[offset:offset + len(magic)] == magic:
+            return name
+    return None
+
+
+def decompress_stream(stream, compression: str):
+    if compression == 'gzip':
+        return CheckedReader(gzip.GzipFile(fileobj=stream))
+    elif compression == 'bzip2':
+        return CheckedReader(bz2.BZ2File(stream))
+    elif compression in ('xz', 'lzma'):
+        return CheckedReader(lzma.LZMAFile(stream))
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ExtractError('zstandard is not installed')
+        return CheckedReader(zstandard.ZstdDecompressor().stream_reader(stream), (zstandard.ZstdError,))
+    raise ExtractError('unknown compression ' + compression)
+
+
+def open_decompressed(fin, compression: str):
+    """
+    decompress_stream() of a whole file; a large file is decoded on the decompression pool
+    when it has independent blocks, otherwise on a read-ahead thread
+    """
+    stream = parallel_stream(fin, compression)
+    if stream is not None:
+        return CheckedReader(stream)
+    stream = decompress_stream(fin, compression)
+    if large_input(fin):
+        stream = ReadaheadReader(stream)
+    return stream
+
+
+def is_tar_header(block: bytes) -> bool:
+    """
+    a valid ustar/gnu/v7 tar header: the stored checksum matches
+    the byte sum of the header with the checksum field read as spaces
+    """
+    if len(block) < 512:
+        return False
+    if block[257:262] == b'ustar':
+        return True
+    try:
+        stored = int(block[148:156].replace(b'\x00', b' ').strip() or b'-1', 8)
+    except ValueError:
+        return False
+    return stored == sum(block[:148]) + 8 * 32 + sum(block[156:512])
+
+
+def safe_relpath(name: str) -> Optional[str]:
+    """
+    member name as a relative path inside the output directory, None if it would escape it
+    """
+    parts = [_ for _ in name.replace('\\', '/').split('/') if _ not in ('', '.')]
+    if not parts or '..' in parts:
+        return None
+    return os.path.join(*parts)
+
+
+def iter_tar(stream) -> Iterator[Tuple[str, BinaryIO, int, float]]:
+    """
+    (relative path, file object, size, mtime) of every regular file of a tar stream.
+    Symlinks, devices and other special members are skipped.
+    """
+    with tarfile.open(fileobj=stream, mode='r|') as tf:
+        for member in tf:
+            if not member.isfile():
+                continue
+            relpath = safe_relpath(member.name)
+            if relpath is None:
+                logger.warning('skip unsafe member name %s' % member.name)
+                continue
+            yield relpath, tf.extractfile(member), member.size, member.mtime
+
+
+def iter_ar(stream) -> Iterator[Tuple[str, BinaryIO, int]]:
+    """
+    (name, file object, size) of every member of a Unix ar archive, e.g. a .deb.
+    The file object is only valid until the next member is requested.
+    """
+    if stream.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise ExtractError('not an ar archive')
+    while True:
+        header = stream.read(60)
+        if len(header) < 60:
+            return
+        if header[58:60] != b'`\n':
+            raise ExtractError('corrupted ar header')
+        name = header[:16].decode('ascii', 'replace').strip().rstrip('/')
+        size = int(header[48:58].decode('ascii').strip())
+        member = LimitedReader(stream, size)
+        yield name, member, size
+        while member.read(1024 * 1024):
+            pass
+        if size % 2:
+            stream.read(1)
+
+
+def write_member(outdir: str, relpath: str, fileobj, mtime: Optional[float] = None) -> str:
+    dest = pjoin(outdir, relpath)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if os.path.islink(dest):
+        os.remove(dest)
+    with open(dest, 'wb') as fout:
+        copy_out(fileobj, fout)
+    if mtime is not None:
+        os.utime(dest, (mtime, mtime))
+    return dest
+
+
+def extract_tar(stream, outdir: str) -> int:
+    count = 0
+    for relpath, fileobj, _, mtime in iter_tar(stream):
+        write_member(outdir, relpath, fileobj, mtime)
+        count += 1
+    return count
+
+
+def open_zip_member(zf: zipfile.ZipFile, info: zipfile.ZipInfo):
+    """
+    zf.open(info); zipfile raises NotImplementedError for e.g. Deflate64 and RuntimeError
+    for an encrypted member
+    """
+    try:
+        return zf.open(info)
+    except (NotImplementedError, RuntimeError) as e:
+        raise UnsupportedMember('%s: %s' % (info.filename, e))
+
+
+def extract_zip(arcname: str, outdir: str) -> int:
+    count = 0
+    with zipfile.ZipFile(arcname) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            relpath = safe_relpath(info.filename)
+            if relpath is None:
+                continue
+            with open_zip_member(zf, info) as fin:
+                write_member(outdir, relpath, fin)
+            count += 1
+    return count
+
+
+def deb_data_stream(stream):
+    """
+    decompressed data.tar.* member of a Debian package read from stream
+    """
+    for name, member, _ in iter_ar(stream):
+        if not name.startswith('data.tar'):
+            continue
+        head = member.read(6)
+        compression = sniff_compression(head)
+        data = PrefixedReader(head, member)
+        if compression:
+            data = decompress_stream(data, compression)
+        return data
+    raise ExtractError('no data.tar in Debian package')
+
+
+def extract_deb(arcname: str, outdir: str) -> int:
+    """
+    equivalent of `dpkg -x`: extract data.tar.* of a Debian package
+    """
+    with open(arcname, 'rb') as fin:
+        return extract_tar(deb_data_stream(fin), outdir)
+
+
+def rpm_payload_stream(stream):
+    """
+    decompressed cpio payload of an RPM read from stream, compressor taken from the header
+    """
+    payload_format, compressor = open_payload(stream)
+    if payload_format != 'cpio':
+        raise ExtractError('unsupported RPM payload format ' + payload_format)
+    head = stream.read(6)
+    data = PrefixedReader(head, stream)
+    if compressor in ('gzip', 'bzip2', 'xz', 'lzma', 'zstd'):
+        return decompress_stream(data, compressor)
+    compression = sniff_compression(head)
+    return decompress_stream(data, compression) if compression else data
+
+
+def iter_rpm(stream) -> Iterator[Tuple[str, BinaryIO, int, float]]:
+    """
+    (relative path, file object, size, mtime) of every regular file in an RPM, like `rpm2cpio | cpio -idm`
+    """
+    for name, fileobj, size, mtime in iter_cpio(rpm_payload_stream(stream)):
+        relpath = safe_relpath(name)
+        if relpath is None:
+            logger.warning('skip unsafe member name %s' % name)
+            continue
+        yield relpath, fileobj, size, mtime
+
+
+def extract_rpm(arcname: str, outdir: str) -> int:
+    count = 0
+    with open(arcname, 'rb') as fin:
+        for relpath, fileobj, _, mtime in iter_rpm(fin):
+            write_member(outdir, relpath, fileobj, mtime)
+            count += 1
+    return count
+
+
+def is_jar(zf: zipfile.ZipFile) -> bool:
+    return 'META-INF/MANIFEST.MF' in zf.namelist()
+
+
+def streamable(arcname: str) -> bool:
+    """
+    True if iter_members() can list arcname: a tar (optionally compressed), a .deb, an .rpm or a non-jar zip.
+    Costs one header read, plus decoding the first block of a compressed file.
+    """
+    with open(arcname, 'rb') as fin:
+        head = fin.read(512)
+        fin.seek(0)
+        if head.startswith(AR_MAGIC) or head.startswith(RPM_MAGIC) or is_tar_header(head):
+            return True
+        if head.startswith(ZIP_MAGIC):
+            try:
+                with zipfile.ZipFile(fin) as zf:
+                    return not is_jar(zf)
+            except zipfile.BadZipFile:
+                return False
+        compression = sniff_compression(head)
+        if not compression:
+            return False
+        try:
+            return is_tar_header(decompress_stream(fin, compression).read(512))
+        except EXTRACT_ERRORS:
+            # a corrupt or unsupported compressed file is a leaf, not an archive
+            return False
+
+
+def iter_members(arcname: str) -> Iterator[Tuple[str, BinaryIO, Optional[int]]]:
+    """
+    (relative path, file object, size) of every regular file in arcname, read straight out of
+    the archive without extracting it to disk. Each file object must be consumed before the
+    next member is requested. A compressed file that is not a tar yields its payload as the
+    only member, with size None.
+    """
+    with open(arcname, 'rb') as fin:
+        head = fin.read(512)
+        fin.seek(0)
+        if head.startswith(AR_MAGIC):
+            for relpath, fileobj, size, _ in iter_tar(deb_data_stream(fin)):
+                yield relpath, fileobj, size
+            return
+        if head.startswith(RPM_MAGIC):
+            for relpath, fileobj, size, _ in iter_rpm(fin):
+                yield relpath, fileobj, size
+            return
+        if head.startswith(ZIP_MAGIC):
+            with zipfile.ZipFile(fin) as zf:
+                for info in zf.infolist():
+                    relpath = safe_relpath(info.filename)
+                    if info.is_dir() or relpath is None:
+                        continue
+                    with open_zip_member(zf, info) as fileobj:
+                        yield relpath, fileobj, info.file_size
+            return
+        if is_tar_header(head):
+            for relpath, fileobj, size, _ in iter_tar(fin):
+                yield relpath, fileobj, size
+            return
+        compression = sniff_compression(head)
+        if not compression:
+            raise ExtractError('unknown format ' + arcname)
+        with closing(open_decompressed(fin, compression)) as stream:
+            block = stream.read(512)
+            if is_tar_header(block):
+                for relpath, fileobj, size, _ in iter_tar(PrefixedReader(block, stream)):
+                    yield relpath, fileobj, size
+            else:
+                yield splitext(basename(arcname))[0], PrefixedReader(block, stream), None
+
+
+def extract(arcname: str, outdir: str, tmpdir: str) -> Optional[str]:
+    """
+    extract tar, compressed tar, zip, deb and rpm archives in-process.
+    Each compressed stream is decoded exactly once: the first decompressed block is
+    checked for a tar header, and a stream that is not a tar is written out as is.
+    :return: None if the members were written into outdir, or the path of the decompressed
+             payload written into tmpdir when arcname is a single compressed file
+    :raise ExtractError: arcname is not a format handled here
+    """
+    with open(arcname, 'rb') as fin:
+        head = fin.read(512)
+        fin.seek(0)
+        if head.startswith(AR_MAGIC):
+            extract_deb(arcname, outdir)
+            return None
+        if head.startswith(RPM_MAGIC):
+            extract_rpm(arcname, outdir)
+            return None
+        if head.startswith(ZIP_MAGIC):
+            extract_zip(arcname, outdir)
+            return None
+        if is_tar_header(head):
+            extract_tar(fin, outdir)
+            return None
+        compression = sniff_compression(head)
+        if not compression:
+            raise ExtractError('unknown format ' + arcname)
+        with closing(open_decompressed(fin, compression)) as stream:
+            block = stream.read(512)
+            if is_tar_header(block):
+                extract_tar(PrefixedReader(block, stream), outdir)
+                return None
+            payload = pjoin(tmpdir, splitext(basename(arcname))[0])
+            if payload == arcname:
+                payload += '.out'
+            with open(payload, 'wb') as fout:
+                copy_out(PrefixedReader(block, stream), fout)
+            return payload
@@ -6,18 +6,40 @@ import logging
 import traceback
 import sys
 import asyncio
+import threading
 import shutil
-from concurrent.futures import ThreadPoolExecutor
-from urllib.error import HTTPError
+from contextlib import closing
 from urllib.parse import urlparse
 from pprint import pformat
-from pyquery import PyQuery as pq
-from boto3x import upload_file
+from typing import Dict, Iterable, List, Optional
+from boto3x import upload_file, upload_stream, dedup_index
+from manifest import UrlManifest, conditional_headers, is_unchanged
+from resume_download import DownloadError, RangeIgnored, RangeReader, http_download, http_validators, segmentable
+from config import crawl_concurrency, crawl_per_host, streaming_upload, repodata_mode, segment_bytes, \
+    host_max_wait, refresh_concurrency
+from crawler import Crawler
+from download_queue import download_queue
+from host_governor import host_governor, host_of
+from yum_repodata import repodata_bases, iter_packages
 
 
 dl_dir = 'downloads'
 logger = logging.getLogger(__name__)
-executor = ThreadPoolExecutor(os.cpu_count()*2)
+downloads = None
+_manifest = None
+_manifest_lock = threading.Lock()
+
+
+def url_manifest() -> UrlManifest:
+    """
+    the URL manifest, opened on first use rather than when the module is imported
+    """
+    global _manifest
+    with _manifest_lock:
+        if _manifest is None:
+            from config import manifest_db
+            _manifest = UrlManifest(manifest_db)
+        return _manifest
 
 
 def repo_to_regex(repo: str) -> str:
@@ -30,48 +52,100 @@ def repo_to_regex(repo: str) -> str:
     return r
 
 
-def recursion(url: str):
+def already_harvested(f_url: str, entry: Optional[dict], r) -> bool:
+    """
+    True if the response r for f_url shows a file already harvested: unchanged since the URL
+    manifest entry, or of a sha256 the bucket holds; the manifest is brought up to date
+    """
+    if r.status_code == 304 or is_unchanged(entry, r.headers):
+        logger.info('not modified ' + f_url)
+        url_manifest().touch(f_url)
+        return True
+    contentLength = r.headers.get('Content-Length')
+    contentLength = int(contentLength) if contentLength else None
+    index = dedup_index()
+    sha256 = index.lookup(f_url, r.headers['Last-Modified'], contentLength)
+    if sha256 and index.stored([sha256]):
+        logger.info('already stored %s as %s' % (f_url, sha256))
+        url_manifest().put(f_url, r.headers['Last-Modified'], r.headers.get('ETag'), contentLength, sha256)
+        return True
+    return False
+
+
+def stream_file(f_url: str, stream, headers, **kwargs) -> None:
+    """
+    upload f_url from stream without a local copy and record it in the URL manifest
+    :raise RangeIgnored: stream is a RangeReader and the server does not honour Range
+    """
+    from os.path import basename
+    contentLength = headers.get('Content-Length')
+    contentLength = int(contentLength) if contentLength else None
+    logger.info("stream " + f_url)
     try:
-        logger.info('Visit ' + url)
-        d = pq(url=url, verify=False)
-    except HTTPError as e:
-        logger.info("Failed to visit %s  reason: %s" % (url, e.reason))
-        return ''
-
-    items = d('table:nth-child(6) tr td a')
-    if not items:
-        items = d('table:nth-child(13) tr td a')
-    for item in items[1:]:
-        if not item.text:
-            continue
-        item_url = d.base_url + item.attrib['href']
-        if item_url.endswith('/'):
-            yield from recursion(item_url)
-        else:
-            yield item_url
+        sha256 = upload_stream(f_url, stream, basename(urlparse(f_url).path), headers['Content-Type'],
+                               headers['Last-Modified'], **kwargs)
+        if sha256:
+            url_manifest().put(f_url, headers['Last-Modified'], headers.get('ETag'), contentLength, sha256)
+    except RangeIgnored:
+        raise
+    except Exception as e:
+        logger.warning('upload failed:' + f_url)
+        logger.warning(str(e))
+        logger.warning(traceback.format_exc())
 
 
-def download_file(f_url: str) -> None:
+def download_file(f_url: str, ranges: bool = True) -> None:
+    """
+    harvest f_url unless it is known already. A stream is read under the slot of its request;
+    a big file is fetched as parallel ranges, and without streaming_upload through a local
+    file, each of those under host slots of their own.
+    :param ranges: False for a server found to ignore Range
+    """
     import requests
-    import shutil
     from os.path import basename, join as pjoin
     local_f = pjoin(dl_dir, basename(urlparse(f_url).path))
+    entry = url_manifest().get(f_url)
+    host = host_of(f_url)
     try:
-        r = requests.get(f_url, stream=True, timeout=60, verify=False)
-    except HTTPError as e:
+        # HostBusy / HostUnavailable go up to the download queue, which requeues or drops the URL
+        with host_governor().request(host, (requests.RequestException,), host_max_wait) as call:
+            r = requests.get(f_url, stream=True, timeout=60, verify=False,
+                             headers=conditional_headers(entry))
+            call.response(r.status_code, r.headers.get('Retry-After'))
+            if already_harvested(f_url, entry, r):
+                r.close()
+                return
+            if streaming_upload and not (ranges and segmentable(r, http_validators(r))):
+                with closing(r):
+                    stream_file(f_url, r.raw, r.headers)
+                return
+    except requests.RequestException as e:
         logger.info('Failed to download ' + f_url)
-        logger.info(e.reason)
+        logger.info(str(e))
         logger.info(traceback.format_exc())
         return
 
+    if streaming_upload:
+        r.close()
+        try:
+            # one multipart part per range
+            with RangeReader(f_url, http_validators(r), verify=False) as stream:
+                stream_file(f_url, stream, r.headers, part_size=segment_bytes)
+        except RangeIgnored:
+            logger.info('%s ignores Range, stream it whole' % f_url)
+            download_file(f_url, ranges=False)
+        return
     logger.info("download " + f_url)
-    lastModified = r.headers['Last-Modified']
-    contentType = r.headers['Content-Type']
-    with open(local_f, mode='wb') as f:
-        shutil.copyfileobj(r.raw, f)
+    try:
+        http_download(f_url, local_f, response=r, verify=False)
+    except DownloadError as e:
+        logger.warning(str(e))
+        return
     try:
         logger.info('upload %s' % basename(local_f))
-        upload_file(f_url, local_f, contentType, lastModified)
+        sha256 = upload_file(f_url, local_f, r.headers['Content-Type'], r.headers['Last-Modified'])
+        if sha256:
+            url_manifest().put(f_url, r.headers['Last-Modified'], r.headers.get('ETag'), os.path.getsize(local_f), sha256)
     except Exception as e:
         logger.warning('upload failed:' + f_url)
         logger.warning(str(e))
@@ -84,41 +158,139 @@ def download_file(f_url: str) -> None:
         logger.warning(traceback.format_exc())
 
 
-visited_repos = []
+def submit_unknown(pkgs: list) -> int:
+    """
+    queue the packages not in the bucket for download. Repodata with other checksums (sha1
+    "sha" in old repositories) cannot be matched by content; such a package is skipped when
+    the URL manifest has it at the same size with a sha256 that is in the bucket.
+    :return: number of them not harvested before: by sha256 where repodata has it, else by
+    URL manifest, as harvest_root() counts crawled files
+    """
+    entries = {_.url: url_manifest().get(_.url) for _ in pkgs if _.checksum_type != 'sha256'}
+    harvested = {url: entry['sha256'] for url, entry in entries.items() if entry and entry['sha256']}
+    stored = dedup_index().stored([_.checksum for _ in pkgs if _.checksum_type == 'sha256']
+                                  + list(harvested.values()))
+    new = 0
+    for pkg in pkgs:
+        if pkg.checksum_type == 'sha256':
+            if pkg.checksum in stored:
+                continue
+            new += 1
+        elif entries[pkg.url] is None:
+            new += 1
+        elif harvested.get(pkg.url) in stored and entries[pkg.url]['content_length'] in (None, pkg.size):
+            continue
+        logger.info('download ' + pkg.url)
+        downloads.put(pkg.url, pkg.size)
+    return new
+
 
+def harvest_repodata(repo: str) -> Optional[int]:
+    """
+    enumerate a repository template through repodata/primary.xml instead of crawling it.
+    Packages whose sha256 is already in the bucket are not downloaded.
+    :return: number of packages not harvested before, None if no concrete repository of
+    the template publishes repodata
+    """
+    bases = repodata_bases(repo)
+    if not bases:
+        return None
+    new = 0
+    for base, primary_url in bases:
+        logger.info('repodata of %s' % base)
+        batch = []
+        for pkg in iter_packages(base, primary_url):
+            batch.append(pkg)
+            if len(batch) >= 500:
+                new += submit_unknown(batch)
+                batch = []
+        new += submit_unknown(batch)
+    return new
 
-def harvest_csv_file(csv_file: str):
+
+def read_templates(csv_file: str) -> List[str]:
+    """
+    repository templates (first column, http/https only) of csv_file
+    """
+    templates = []
     with open(csv_file, 'r') as f:
         for l in f:
             l = l.strip()  # noqa E741
             l = l.split(',')[0]  # noqa E741
             if not l or not re.match(r'http://|https://', l):
                 continue
-            repo = l
-            logger.info('repo=%s' % repo)
-            reporegex = repo_to_regex(repo)
-            repo = repo.split('$', 1)[0]
-            global visited_repos
-            if repo in visited_repos:
-                continue
-            visited_repos += [repo]
+            templates += [l]
+    return templates
+
+
+async def enqueue(f_url: str) -> None:
+    logger.info('download ' + f_url)
+    # queue full: block a helper thread, not the event loop; the crawl stalls on its own bounded queue
+    if not downloads.offer(f_url):
+        await asyncio.get_event_loop().run_in_executor(None, downloads.put, f_url)
+
 
-            for f_url in recursion(repo):
-                if re.match(reporegex, f_url):
-                    logger.info('download ' + f_url)
-                    global executor
-                    executor.submit(download_file, f_url)
+def crawl_root(repo: str) -> str:
+    """
+    where the crawl of a repository template starts: its URL up to the first $variable
+    """
+    return repo.split('$', 1)[0]
+
+
+def group_templates(templates: Iterable[str]) -> Dict[str, List[str]]:
+    """
+    templates by crawl_root(); many templates share a root and are harvested by one crawl of it
+    """
+    roots = {}
+    for repo in templates:
+        repos = roots.setdefault(crawl_root(repo), [])
+        if repo not in repos:
+            repos.append(repo)
+    return roots
+
+
+async def harvest_root(root: str, templates: List[str]) -> int:
+    """
+    refresh the repository templates under one crawl root, each through its repodata if it
+    has any, the others by a single crawl of root
+    :return: number of files found that were not harvested before
+    """
+    loop = asyncio.get_event_loop()
+    new = 0
+    reporegexs = []
+    for repo in templates:
+        if repodata_mode:
+            queued = await loop.run_in_executor(None, harvest_repodata, repo)
+            if queued is not None:
+                new += queued
+                continue
+        reporegexs.append(re.compile(repo_to_regex(repo)))
+    if not reporegexs:
+        return new
+    crawler = Crawler(concurrency=crawl_concurrency, per_host=crawl_per_host)
+    async for f_url in crawler.files([root]):
+        if any(_.match(f_url) for _ in reporegexs):
+            if url_manifest().get(f_url) is None:
+                new += 1
+            await enqueue(f_url)
+    return new
 
 
 async def main():
+    global downloads
     try:
         if os.path.exists(dl_dir):
             shutil.rmtree(dl_dir, ignore_errors=True)
         os.makedirs(dl_dir, exist_ok=True)
-        harvest_csv_file('fim_linux_repository.csv')
-        harvest_csv_file('list of repositories.csv')
-        global executor
-        executor.shutdown(wait=True)
+        downloads = download_queue(download_file)
+        templates = read_templates('fim_linux_repository.csv') + read_templates('list of repositories.csv')
+        slots = asyncio.Semaphore(refresh_concurrency)
+
+        async def harvest(root: str, repos: List[str]) -> None:
+            async with slots:
+                await harvest_root(root, repos)
+        await asyncio.gather(*(harvest(root, repos) for root, repos in group_templates(templates).items()))
+        downloads.close()
     except KeyboardInterrupt:
         return
     except Exception as e:
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import json
+import ftplib
+import sqlite3
+import threading
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterator, List, Optional, Tuple
+from ftp_pool import FTP_ERRORS, FtpPool
+
+logger = logging.getLogger(__name__)
+
+# (name, is_dir, modify)
+Entry = Tuple[str, bool, Optional[str]]
+
+
+class ListingCache(object):
+    """
+    persistent FTP directory listings keyed by host, path and the directory's modify time,
+    so a directory whose modify time did not change is not listed again
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS ftp_listing ('
+                ' host TEXT,'
+                ' path TEXT,'
+                ' modify TEXT,'
+                ' entries TEXT,'
+                ' PRIMARY KEY (host, path))')
+
+    def get(self, host: str, path: str, modify: str) -> Optional[List[Entry]]:
+        with self.lock:
+            row = self.conn.execute('SELECT entries FROM ftp_listing WHERE host=? AND path=? AND modify=?',
+                                    (host, path, modify)).fetchone()
+        if not row:
+            return None
+        return [tuple(_) for _ in json.loads(row[0])]
+
+    def put(self, host: str, path: str, modify: str, entries: List[Entry]) -> None:
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO ftp_listing VALUES (?, ?, ?, ?)',
+                              (host, path, modify, json.dumps(entries)))
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+def dir_modify(ftp: ftplib.FTP, path: str) -> Optional[str]:
+    """
+    modify fact of path from MLST, answered on the control connection without opening a
+    data connection; None if the server has no MLST
+    """
+    try:
+        resp = ftp.sendcmd('MLST ' + path)
+    except ftplib.error_perm:
+        return None
+    lines = resp.splitlines()
+    if len(lines) < 2:
+        return None
+    for fact in lines[1].strip().split(' ', 1)[0].split(';'):
+        name, _, value = fact.partition('=')
+        if name.lower() == 'modify':
+            return value
+    return None
+
+
+def list_dir(ftp: ftplib.FTP, path: str) -> List[Entry]:
+    """
+    entries of path with MLSD, or a parsed Unix LIST on servers without it; symlinks are skipped
+    """
+    try:
+        return [(name, facts.get('type') == 'dir', facts.get('modify'))
+                for name, facts in ftp.mlsd(path, facts=['type', 'modify'])
+                if facts.get('type') in ('dir', 'file')]
+    except ftplib.error_perm as e:
+        if not str(e).startswith('50'):
+            raise
+    lines = []
+    ftp.retrlines('LIST ' + path, lines.append)
+    entries = []
+    for line in lines:
+        fields = line.split(None, 8)
+        if len(fields) < 9 or line[0] not in 'd-' or fields[8] in ('.', '..'):
+            continue
+        entries.append((fields[8], line[0] == 'd', None))
+    return entries
+
+
+def walk(pool: FtpPool, host: str, roots: List[str], cache: Optional[ListingCache] = None,
+         workers: Optional[int] = None) -> Iterator[Tuple[str, str]]:
+    """
+    (directory, file name) of every file under roots, listing directories in parallel over
+    the pooled connections. With a cache, a directory is only re-listed when its MLST modify
+    time changed since it was cached.
+    """
+    def scan(path: str, retries: int = 3) -> List[Entry]:
+        for attempt in range(retries):
+            try:
+                with pool.connection(host) as ftp:
+                    modify = dir_modify(ftp, path) if cache else None
+                    if modify:
+                        entries = cache.get(host, path, modify)
+                        if entries is not None:
+                            return entries
+                    entries = list_dir(ftp, path)
+                break
+            except FTP_ERRORS:
+                if attempt == retries - 1:
+                    raise
+        if modify:
+            cache.put(host, path, modify, entries)
+        return entries
+
+    with ThreadPoolExecutor(workers or pool.size, thread_name_prefix='ftp-list') as executor:
+        pending = {executor.submit(scan, root): root for root in roots}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    entries = future.result()
+                except ftplib.all_errors as e:
+                    logger.warning('list %s failed %s' % (path, e))
+                    continue
+                for name, is_dir, _ in entries:
+                    child = path.rstrip('/') + '/' + name
+                    if is_dir:
+                        pending[executor.submit(scan, child)] = child
+                    else:
+                        yield path, name
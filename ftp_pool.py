@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import time
+import ftplib
+import calendar
+import threading
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from email.utils import formatdate
+from typing import Optional
+from urllib.parse import urlsplit
+from resume_download import PartialFile
+from host_governor import HostUnavailable, host_governor
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# errors after which a control connection is not trusted any more
+FTP_ERRORS = (ftplib.error_temp, ftplib.error_proto, ftplib.error_reply, OSError, EOFError)
+
+
+class FtpPool(object):
+    """
+    logged-in control connections kept per host and reused across transfers.
+    At most `size` connections per host are open, so at most `size` transfers run at once;
+    an idle connection is probed with NOOP before reuse, and a connection that failed is
+    dropped and replaced by a fresh login on the next checkout.
+    """
+
+    def __init__(self, size: int = 4, user: str = 'anonymous', passwd: str = 'john@gmail.com',
+                 timeout: int = 20, idle_probe: float = 30):
+        self.size = size
+        self.user = user
+        self.passwd = passwd
+        self.timeout = timeout
+        self.idle_probe = idle_probe
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list)  # host -> [(ftp, last used)]
+        self.slots = defaultdict(lambda: threading.BoundedSemaphore(self.size))
+
+    def _login(self, host: str) -> ftplib.FTP:
+        ftp = ftplib.FTP(host, timeout=self.timeout)
+        ftp.login(self.user, self.passwd)
+        ftp.voidcmd('TYPE I')
+        return ftp
+
+    def _checkout(self, host: str) -> ftplib.FTP:
+        while True:
+            with self.lock:
+                if not self.idle[host]:
+                    break
+                ftp, last_used = self.idle[host].pop()
+            if time.monotonic() - last_used < self.idle_probe:
+                return ftp
+            try:
+                ftp.voidcmd('NOOP')
+                return ftp
+            except FTP_ERRORS:
+                self._drop(ftp)
+        logger.debug('ftp login %s' % host)
+        return self._login(host)
+
+    @staticmethod
+    def _drop(ftp: ftplib.FTP) -> None:
+        try:
+            ftp.close()
+        except OSError:
+            pass
+
+    @contextmanager
+    def connection(self, host: str):
+        """
+        a logged-in connection to host, in binary mode; blocks while all of host's connections
+        are busy or the host governor holds the host back
+        :raise HostUnavailable: the host's circuit breaker is open
+        """
+        with self.lock:
+            slots = self.slots[host]
+        with host_governor().request(host, FTP_ERRORS) as call, slots:
+            ftp = self._checkout(host)
+            call.response()
+            try:
+                yield ftp
+            except ftplib.error_perm:
+                # the server refused the command, the session itself is fine
+                self._release(host, ftp)
+                raise
+            except BaseException:
+                self._drop(ftp)
+                with self.lock:
+                    # the others may have gone the same way (server restart, NAT timeout): probe them before reuse
+                    self.idle[host] = [(conn, 0) for conn, _ in self.idle[host]]
+                raise
+            self._release(host, ftp)
+
+    def _release(self, host: str, ftp: ftplib.FTP) -> None:
+        with self.lock:
+            self.idle[host].append((ftp, time.monotonic()))
+
+    def close(self) -> None:
+        with self.lock:
+            idle, self.idle = self.idle, defaultdict(list)
+        for conns in idle.values():
+            for ftp, _ in conns:
+                try:
+                    ftp.quit()
+                except FTP_ERRORS:
+                    self._drop(ftp)
+
+
+def ftp_pool() -> FtpPool:
+    """
+    process-wide pool, config.ftp_connections connections per host
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            from config import ftp_connections
+            _pool = FtpPool(ftp_connections)
+        return _pool
+
+
+def mdtm(ftp: ftplib.FTP, path: str) -> Optional[str]:
+    """
+    modification time of path as an HTTP date, None if the server does not support MDTM
+    """
+    try:
+        resp = ftp.sendcmd('MDTM ' + path)
+    except ftplib.error_perm:
+        return None
+    stamp = time.strptime(resp.split()[1][:14], '%Y%m%d%H%M%S')
+    return formatdate(calendar.timegm(stamp), usegmt=True)
+
+
+def size(ftp: ftplib.FTP, path: str) -> Optional[int]:
+    """
+    size of path in bytes, None if the server does not support SIZE
+    """
+    try:
+        return ftp.size(path)
+    except ftplib.error_perm:
+        return None
+
+
+def download(pool: FtpPool, ftp_url: str, local_f: str, retries: int = 5) -> Optional[str]:
+    """
+    download ftp_url to local_f over a pooled connection. A transfer that breaks is resumed
+    with REST on a fresh connection, as long as the file's MDTM and SIZE did not change;
+    only attempts that made no progress count against retries. A permanent error
+    (e.g. 550 no such file) or HostUnavailable is raised at once.
+    :return: Last-Modified of the file as an HTTP date, if known
+    """
+    parts = urlsplit(ftp_url)
+    partial = PartialFile(local_f, ftp_url)
+    failures = 0
+    while True:
+        offset = partial.offset
+        try:
+            with pool.connection(parts.hostname) as ftp:
+                validators = {'last_modified': mdtm(ftp, parts.path), 'size': size(ftp, parts.path)}
+                if not partial.resumable(validators):
+                    offset = 0
+                    partial.start(validators)
+                elif offset:
+                    logger.info('resume %s at %d' % (ftp_url, offset))
+                with partial.open() as fout:
+                    try:
+                        ftp.retrbinary('RETR ' + parts.path, fout.write, blocksize=1024 * 1024, rest=offset or None)
+                    except ftplib.error_perm:
+                        if not offset:
+                            raise
+                        # REST refused: start over without it
+                        partial.discard()
+                        raise EOFError('REST %d refused' % offset)
+            if validators['size'] is not None and partial.offset != validators['size']:
+                raise EOFError('%d of %d bytes' % (partial.offset, validators['size']))
+            partial.finish()
+            return validators['last_modified']
+        except HostUnavailable:
+            raise
+        except FTP_ERRORS as e:
+            failures = 0 if partial.offset > offset else failures + 1
+            if failures >= retries:
+                raise
+            logger.info('retry %d %s at %d: %s' % (failures, ftp_url, partial.offset, e))
+            time.sleep(min(2 ** failures, 30))
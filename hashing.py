@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import os
+import hashlib
+import threading
+import logging
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List
+
+logger = logging.getLogger(__name__)
+
+Digests = namedtuple('Digests', ['md5', 'sha1', 'sha256'])
+
+chunk_size = 1024 * 1024
+cache_size = 100000
+
+_local = threading.local()
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class MultiHash(object):
+    """
+    md5, sha1 and sha256 of the same bytes, updated together
+    """
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.sha1 = hashlib.sha1()
+        self.sha256 = hashlib.sha256()
+
+    def update(self, data) -> None:
+        self.md5.update(data)
+        self.sha1.update(data)
+        self.sha256.update(data)
+
+    def digests(self) -> Digests:
+        return Digests(self.md5.hexdigest(), self.sha1.hexdigest(), self.sha256.hexdigest())
+
+
+def _buffer() -> memoryview:
+    buf = getattr(_local, 'buf', None)
+    if buf is None:
+        buf = _local.buf = memoryview(bytearray(chunk_size))
+    return buf
+
+
+def _cache_key(st: os.stat_result) -> tuple:
+    # ctime as well: extraction sets the archive's mtime, and a freed inode is soon reused
+    return st.st_dev, st.st_ino, st.st_mtime_ns, st.st_ctime_ns, st.st_size
+
+
+def forget_hashes() -> None:
+    """
+    drop the cached digests; called when a tree of hashed files is removed, since even
+    ctime only ticks every few milliseconds for a file recreated on a reused inode
+    """
+    with _cache_lock:
+        _cache.clear()
+
+
+def hash_file(fname: str) -> Digests:
+    """
+    md5/sha1/sha256 of a file in one chunked pass through a reused per-thread buffer,
+    so memory stays flat whatever the file size.
+    Results are cached by (device, inode, mtime, ctime, size): later stages asking for another
+    digest of the same file do not read it again.
+    """
+    with open(fname, 'rb') as f:
+        key = _cache_key(os.fstat(f.fileno()))
+        with _cache_lock:
+            digests = _cache.get(key)
+            if digests is not None:
+                _cache.move_to_end(key)
+                return digests
+        h = MultiHash()
+        buf = _buffer()
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(buf[:n])
+    digests = h.digests()
+    with _cache_lock:
+        _cache[key] = digests
+        while len(_cache) > cache_size:
+            _cache.popitem(last=False)
+    return digests
+
+
+def hash_pool() -> ThreadPoolExecutor:
+    """
+    shared pool for hashing; hashlib releases the GIL on large buffers so threads scale
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            from config import hash_workers
+            _pool = ThreadPoolExecutor(hash_workers, thread_name_prefix='hash')
+        return _pool
+
+
+def hash_files(fnames: Iterable[str]) -> List[Digests]:
+    """
+    hash_file() of many files on the hashing pool, results in input order
+    """
+    return list(hash_pool().map(hash_file, fnames))
+
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import time
+import asyncio
+import threading
+import logging
+from typing import Optional, Tuple
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+class HostUnavailable(ConnectionError):
+    """
+    the host's circuit breaker is open: it failed too often in a row
+    """
+    pass
+
+
+class HostBusy(HostUnavailable):
+    """
+    no request slot for the host came free within the caller's max_wait
+    """
+    pass
+
+
+def host_of(url: str) -> str:
+    return (urlsplit(url).hostname or url).lower()
+
+
+class HostState(object):
+    def __init__(self, tokens: float, limit: float, open_seconds: float):
+        self.tokens = tokens
+        self.stamp = time.monotonic()
+        self.limit = limit
+        self.inflight = 0
+        self.latency = None  # EWMA of time to first response, seconds
+        self.baseline = None  # lowest latency seen, drifting up slowly
+        self.failures = 0  # requests in a row without an answer
+        self.open_until = 0.0  # circuit open until; non-zero and past means half-open
+        self.open_seconds = open_seconds
+        self.not_before = 0.0  # Retry-After
+        self.decreased = 0.0
+
+
+class HostGovernor(object):
+    """
+    per-host politeness and capacity shared by the HTTP and FTP paths.
+    Every request to a host takes a token from the host's bucket (`rate` per second, up
+    to `burst`) and one of its concurrency slots. The slot count follows AIMD: it grows by
+    1/limit per fast success, and is cut by half on a transport error or a 429/503 (and by
+    a tenth when latency climbs past `latency_factor` times the best seen), at most once per
+    second. After `failure_threshold` requests in a row got no answer or a 5xx, the host's
+    circuit opens: requests fail at once with HostUnavailable for `open_seconds`, doubling
+    up to `max_open_seconds` while a single probe request after each period keeps failing.
+    """
+
+    def __init__(self, rate: float = 10.0, burst: int = 20, initial_limit: int = 4, max_limit: int = 32,
+                 failure_threshold: int = 5, open_seconds: float = 60, max_open_seconds: float = 900,
+                 latency_factor: float = 3.0):
+        self.rate = rate
+        self.burst = burst
+        self.initial_limit = initial_limit
+        self.max_limit = max_limit
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.latency_factor = latency_factor
+        self.cond = threading.Condition()
+        self.hosts = {}
+
+    def _state(self, host: str) -> HostState:
+        st = self.hosts.get(host)
+        if st is None:
+            st = self.hosts[host] = HostState(self.burst, self.initial_limit, self.open_seconds)
+        return st
+
+    def _enter(self, host: str) -> float:
+        """
+        with self.cond held: take a token and a slot of host
+        :return: 0 if taken, else seconds to wait before trying again
+        :raise HostUnavailable: host's circuit is open
+        """
+        st = self._state(host)
+        now = time.monotonic()
+        if st.open_until > now:
+            raise HostUnavailable('%s is down, retry in %d s' % (host, st.open_until - now))
+        # half-open: one probe at a time
+        limit = 1 if st.open_until else int(st.limit)
+        if st.inflight >= limit:
+            return 1.0
+        st.tokens = min(self.burst, st.tokens + (now - st.stamp) * self.rate)
+        st.stamp = now
+        wait = max(st.not_before - now, (1 - st.tokens) / self.rate)
+        if wait > 0:
+            return wait
+        st.tokens -= 1
+        st.inflight += 1
+        return 0
+
+    def acquire(self, host: str, max_wait: Optional[float] = None) -> None:
+        """
+        block until a request to host may go out
+        :raise HostBusy: not within max_wait seconds
+        :raise HostUnavailable: host's circuit is open
+        """
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        with self.cond:
+            while True:
+                wait = self._enter(host)
+                if not wait:
+                    return
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise HostBusy('%s has no free slot' % host)
+                    wait = min(wait, remaining)
+                self.cond.wait(wait)
+
+    async def acquire_async(self, host: str, max_wait: Optional[float] = None) -> None:
+        """
+        acquire() for coroutines; polls instead of blocking the event loop
+        """
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            with self.cond:
+                wait = self._enter(host)
+            if not wait:
+                return
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise HostBusy('%s has no free slot' % host)
+                wait = min(wait, remaining)
+            await asyncio.sleep(min(wait, 0.2))
+
+    def _decrease(self, st: HostState, factor: float, now: float) -> None:
+        # one cut per second: a burst of failures from requests already in flight is one signal
+        if now - st.decreased >= 1.0:
+            st.limit = max(1.0, st.limit * factor)
+            st.decreased = now
+
+    def release(self, host: str, outcome: str, latency: Optional[float] = None,
+                retry_after: Optional[float] = None) -> None:
+        """
+        give back host's slot and adapt to how the request went
+        :param outcome: 'ok', 'throttled' (429/503), 'error' (no answer, or a 5xx), 'broken'
+        (transport error after the host answered) or 'neutral'
+        """
+        now = time.monotonic()
+        with self.cond:
+            st = self._state(host)
+            st.inflight -= 1
+            if outcome == 'ok':
+                st.failures = 0
+                if st.open_until:
+                    logger.info('%s is back' % host)
+                    st.open_until, st.open_seconds = 0.0, self.open_seconds
+                if latency is not None:
+                    st.latency = latency if st.latency is None else 0.8 * st.latency + 0.2 * latency
+                    st.baseline = latency if st.baseline is None else min(st.baseline * 1.01, latency)
+                if latency is not None and st.latency > self.latency_factor * st.baseline:
+                    self._decrease(st, 0.9, now)
+                else:
+                    st.limit = min(self.max_limit, st.limit + 1 / st.limit)
+            elif outcome == 'throttled':
+                self._decrease(st, 0.5, now)
+                st.not_before = max(st.not_before, now + (retry_after or 1.0))
+            elif outcome == 'broken':
+                self._decrease(st, 0.5, now)
+            elif outcome == 'error':
+                st.failures += 1
+                self._decrease(st, 0.5, now)
+                if st.open_until or st.failures >= self.failure_threshold:
+                    logger.warning('%s failed %d times in a row, pause it for %d s'
+                                   % (host, st.failures, st.open_seconds))
+                    st.open_until = now + st.open_seconds
+                    st.open_seconds = min(self.max_open_seconds, st.open_seconds * 2)
+            self.cond.notify_all()
+
+    def request(self, host: str, errors: Tuple[type, ...] = (), max_wait: Optional[float] = None) -> 'Call':
+        """
+        context manager (with or async with) around one request to host
+        :param errors: exception types that count as a transport error of the host
+        """
+        return Call(self, host, errors, max_wait)
+
+
+class Call(object):
+    """
+    one request under a HostGovernor slot. response() records the status and the time
+    to the first response; the slot is given back when the block exits.
+    """
+
+    def __init__(self, governor: HostGovernor, host: str, errors: Tuple[type, ...], max_wait: Optional[float]):
+        self.governor = governor
+        self.host = host
+        self.errors = errors
+        self.max_wait = max_wait
+        self.start = None
+        self.status = None
+        self.latency = None
+        self.retry_after = None
+
+    def response(self, status: Optional[int] = None, retry_after: Optional[str] = None) -> None:
+        self.status = status
+        self.latency = time.monotonic() - self.start
+        if retry_after and retry_after.isdigit():
+            self.retry_after = float(retry_after)
+
+    def outcome(self, exc: Optional[BaseException]) -> str:
+        if self.status in (429, 503):
+            return 'throttled'
+        # before the errors: a 5xx is raised as one by callers, and it is the host failing
+        if self.status is not None and self.status >= 500:
+            return 'error'
+        if exc is not None and isinstance(exc, self.errors):
+            # a transfer that broke after the host answered: a bad link, not a host that is down
+            return 'broken' if self.latency is not None else 'error'
+        if exc is not None and self.latency is None:
+            return 'neutral'
+        return 'ok'
+
+    def __enter__(self) -> 'Call':
+        self.governor.acquire(self.host, self.max_wait)
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.governor.release(self.host, self.outcome(exc), self.latency, self.retry_after)
+        return False
+
+    async def __aenter__(self) -> 'Call':
+        await self.governor.acquire_async(self.host, self.max_wait)
+        self.start = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        return self.__exit__(exc_type, exc, tb)
+
+
+def host_governor() -> HostGovernor:
+    """
+    process-wide governor configured from config.host_*
+    """
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            from config import host_rate, host_burst, host_initial_limit, host_max_limit, \
+                host_failure_threshold, host_open_seconds
+            _governor = HostGovernor(host_rate, host_burst, host_initial_limit, host_max_limit,
+                                     host_failure_threshold, host_open_seconds)
+        return _governor
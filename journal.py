@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import os
+import json
+import time
+import threading
+import logging
+from typing import Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class StepJournal(object):
+    """
+    append-only JSON-lines journal of the message being processed: one line per stage
+    transition, with the state needed to resume it, and one line per uploaded child.
+    Stage lines are fsync'ed at once; child lines in batches of `sync_every` or every
+    `sync_interval` seconds, so a hard kill re-uploads at most a batch of children.
+    The journal is truncated when a new message starts.
+    """
+
+    def __init__(self, path: str, sync_every: int = 64, sync_interval: float = 1.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+        self.repair()
+        self.fout = open(path, 'a')
+
+    def repair(self) -> None:
+        """
+        cut a torn last line left by a crash, so the next entry does not get glued onto it
+        """
+        try:
+            f = open(self.path, 'r+b')
+        except FileNotFoundError:
+            return
+        with f:
+            end = f.seek(0, os.SEEK_END)
+            pos = end
+            while pos > 0:
+                start = max(0, pos - 4096)
+                f.seek(start)
+                block = f.read(pos - start)
+                nl = block.rfind(b'\n')
+                if nl >= 0:
+                    pos = start + nl + 1
+                    break
+                pos = start
+            if pos < end:
+                logger.warning('cut torn journal line in %s' % self.path)
+                f.truncate(pos)
+                os.fsync(f.fileno())
+
+    def load(self) -> Tuple[str, dict, Set[str]]:
+        """
+        (last stage, state merged over the message's stages, children uploaded since the
+        message started) to resume from; a torn last line left by a crash is ignored
+        """
+        step, state, done = '', {}, set()
+        with open(self.path, 'r') as fin:
+            for line in fin:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning('skip torn journal line in %s' % self.path)
+                    continue
+                if 'step' in entry:
+                    step = entry.pop('step')
+                    state.update(entry)
+                elif 'done' in entry:
+                    done.add(entry['done'])
+        return step, state, done
+
+    def _append(self, entry: dict, sync: bool) -> None:
+        with self.lock:
+            self.fout.write(json.dumps(entry) + '\n')
+            self.unsynced += 1
+            if sync or self.unsynced >= self.sync_every \
+                    or time.monotonic() - self.synced_at >= self.sync_interval:
+                self._sync()
+
+    def _sync(self) -> None:
+        self.fout.flush()
+        os.fsync(self.fout.fileno())
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+
+    def stage(self, step: str, **state) -> None:
+        state['step'] = step
+        self._append(state, sync=True)
+
+    def child_done(self, child: str, key: Optional[str] = None) -> None:
+        self._append({'done': child, 'key': key}, sync=False)
+
+    def reset(self) -> None:
+        """
+        forget the finished message
+        """
+        with self.lock:
+            self.fout.truncate(0)
+            self._sync()
+
+    def close(self) -> None:
+        with self.lock:
+            self._sync()
+            self.fout.close()
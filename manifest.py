@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import sqlite3
+import threading
+import time
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class UrlManifest(object):
+    """
+    persistent record of every harvested URL and the validators it was served with,
+    so that the next run can issue conditional GETs instead of re-downloading.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS url_manifest ('
+                ' url TEXT PRIMARY KEY,'
+                ' last_modified TEXT,'
+                ' etag TEXT,'
+                ' content_length INTEGER,'
+                ' sha256 TEXT,'
+                ' checked_at REAL)')
+
+    def get(self, url: str) -> Optional[dict]:
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT last_modified, etag, content_length, sha256 FROM url_manifest WHERE url=?',
+                (url,)).fetchone()
+        if not row:
+            return None
+        return dict(last_modified=row[0], etag=row[1], content_length=row[2], sha256=row[3])
+
+    def put(self, url: str, last_modified: Optional[str], etag: Optional[str],
+            content_length: Optional[int], sha256: Optional[str]) -> None:
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO url_manifest VALUES (?, ?, ?, ?, ?, ?)',
+                (url, last_modified, etag, content_length, sha256, time.time()))
+
+    def touch(self, url: str) -> None:
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE url_manifest SET checked_at=? WHERE url=?',
+                              (time.time(), url))
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+def conditional_headers(entry: Optional[dict]) -> dict:
+    headers = {}
+    if not entry:
+        return headers
+    if entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def is_unchanged(entry: Optional[dict], headers) -> bool:
+    """
+    True if the response validators match the manifest entry.
+    Covers mirrors that ignore If-Modified-Since/If-None-Match and answer 200 anyway.
+    """
+    if not entry or not entry['sha256']:
+        return False
+    etag = headers.get('ETag')
+    if etag and entry['etag']:
+        return etag == entry['etag']
+    last_modified = headers.get('Last-Modified')
+    content_length = headers.get('Content-Length')
+    if not last_modified or last_modified != entry['last_modified']:
+        return False
+    if content_length is not None and entry['content_length'] is not None:
+        return int(content_length) == entry['content_length']
+    return True
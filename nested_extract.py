@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import os
+import signal
+import shutil
+import tempfile
+import logging
+import traceback
+import multiprocessing
+from os.path import join as pjoin
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterable, Iterator, List, Optional, Tuple
+from unpack_archive import NotSupportedFileType, unpack_archive, unpack_zip
+from extract import EXTRACT_ERRORS, streamable, write_budget
+from hashing import forget_hashes, hash_files
+from sniff import sniff, sniff_header
+
+logger = logging.getLogger(__name__)
+
+# directory a nested archive is unpacked into, next to the archive itself
+NEST_SUFFIX = '!'
+# formats that always hold other files; a nested jar is opened too, unlike a top-level one
+CONTAINER_KINDS = {'rpm', 'deb', 'tar', 'zip', 'jar', 'squashfs', 'arj', 'lzop', 'lzip', 'iso', 'iso.gz'}
+# single-file compressors, only unpacked when they hold a tar
+COMPRESSED_KINDS = {'gzip', 'bzip2', 'xz'}
+
+
+def is_nested_archive(fpath: str) -> bool:
+    """
+    True if fpath is worth unpacking as a nested archive. A bare compressed file
+    (e.g. a gzipped man page) is left alone.
+    """
+    try:
+        kind = sniff(fpath).kind
+        if kind in CONTAINER_KINDS:
+            return True
+        return kind in COMPRESSED_KINDS and streamable(fpath)
+    except EXTRACT_ERRORS as e:
+        # a corrupt member is uploaded as it is, it must not fail the whole unpack
+        logger.info('leave %s as a leaf: %r' % (fpath, e))
+        return False
+
+
+def limit_file_size(max_bytes: int) -> None:
+    """
+    cap every file this process and the external unpackers it runs write at max_bytes;
+    a write past it fails with EFBIG instead of killing the process
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+    signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+    _, hard = resource.getrlimit(resource.RLIMIT_FSIZE)
+    if hard != resource.RLIM_INFINITY:
+        max_bytes = min(max_bytes, hard)
+    resource.setrlimit(resource.RLIMIT_FSIZE, (max_bytes, hard))
+
+
+def unpack_one(arcname: str, outdir: str, max_bytes: int) -> Optional[List[Tuple[str, str, int]]]:
+    """
+    process pool task: unpack_archive() of one nested archive, writing at most max_bytes.
+    In-process extraction stops as soon as the budget is spent; external unpackers are held
+    to it per file.
+    :return: (relative path, sha1, size) of its children, None if it cannot be unpacked
+    or would expand past max_bytes
+    """
+    os.makedirs(outdir, exist_ok=True)
+    limit_file_size(max_bytes)
+    try:
+        with write_budget(max_bytes):
+            ftype = sniff(arcname)
+            if ftype.kind == 'jar':
+                with tempfile.TemporaryDirectory(suffix='.dir') as tmpdir:
+                    unpack_zip(arcname, outdir, tmpdir, ftype.desc)
+                fpaths = [pjoin(root, f) for root, _, files in os.walk(outdir) for f in files]
+                children = [(os.path.relpath(f, outdir), digests.sha1) for f, digests in zip(fpaths, hash_files(fpaths))]
+            else:
+                children = list(unpack_archive(arcname, outdir))
+        return [(relpath, sha1, os.path.getsize(pjoin(outdir, relpath))) for relpath, sha1 in children]
+    except (NotSupportedFileType, ) + EXTRACT_ERRORS as e:
+        logger.info('leave %s packed: %r' % (arcname, e))
+        shutil.rmtree(outdir, ignore_errors=True)
+        forget_hashes()
+        return None
+
+
+def nested_header(head: bytes) -> bool:
+    """
+    True if a file starting with head may be a nested archive; is_nested_archive() decides
+    once it is on disk
+    """
+    ftype = sniff_header(head, None)
+    return ftype is not None and (ftype.kind in CONTAINER_KINDS or ftype.kind in COMPRESSED_KINDS)
+
+
+def unpack_nested(arcname: str, outdir: str, max_depth: Optional[int] = None,
+                  max_ratio: Optional[int] = None, max_total_bytes: Optional[int] = None,
+                  workers: Optional[int] = None) -> Iterator[Tuple[str, str]]:
+    """
+    unpack_archive(), then expand_nested() its children
+    :raise NotSupportedFileType: arcname itself cannot be unpacked
+    """
+    yield from expand_nested(unpack_archive(arcname, outdir), outdir, max_depth, max_ratio,
+                             max_total_bytes, workers)
+
+
+def expand_nested(children: Iterable[Tuple[str, Optional[str]]], outdir: str, max_depth: Optional[int] = None,
+                  max_ratio: Optional[int] = None, max_total_bytes: Optional[int] = None,
+                  workers: Optional[int] = None) -> Iterator[Tuple[str, Optional[str]]]:
+    """
+    (relative path, sha1) of children, files already in outdir, followed by the members of every
+    child that is itself an archive, unpacked on a process pool recursively up to max_depth
+    levels. A nested archive is still yielded as a child; its members follow as
+    '<archive path>!/<member path>'. Each unpack may write at most max_ratio times the
+    archive's size and what is left of max_total_bytes; past that the archive is left packed.
+    """
+    from config import nested_max_depth, nested_max_ratio, nested_max_bytes, nested_workers
+    max_depth = nested_max_depth if max_depth is None else max_depth
+    max_ratio = max_ratio or nested_max_ratio
+    max_total_bytes = max_total_bytes or nested_max_bytes
+    total = 0
+    reserved = 0  # budgets handed to running unpacks
+    pending = {}  # future -> (relpath, depth, budget)
+
+    # spawn: forked workers would inherit the hashing and decompression thread pools without their threads
+    with ProcessPoolExecutor(workers or nested_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        def visit(children: Iterable[Tuple[str, Optional[str]]], depth: int):
+            nonlocal total, reserved
+            for relpath, sha1 in children:
+                yield relpath, sha1
+                fpath = pjoin(outdir, relpath)
+                if not os.path.isfile(fpath):
+                    continue
+                size = os.path.getsize(fpath)
+                total += size
+                budget = min(max_ratio * max(size, 1), max_total_bytes - total - reserved)
+                if depth < max_depth and budget > 0 and is_nested_archive(fpath):
+                    future = pool.submit(unpack_one, fpath, fpath + NEST_SUFFIX, budget)
+                    pending[future] = (relpath, depth + 1, budget)
+                    reserved += budget
+
+        yield from visit(children, 0)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                relpath, depth, budget = pending.pop(future)
+                reserved -= budget
+                nested_dir = pjoin(outdir, relpath + NEST_SUFFIX)
+                try:
+                    nested = future.result()
+                except OSError:
+                    # a full disk or the like fails the job instead of silently leaving the archive packed
+                    raise
+                except Exception as e:
+                    logger.warning('unpack nested %s failed %s' % (relpath, e))
+                    logger.warning(traceback.format_exc())
+                    shutil.rmtree(nested_dir, ignore_errors=True)
+                    continue
+                if nested is None:
+                    continue
+                yield from visit([(relpath + NEST_SUFFIX + '/' + child, sha1) for child, sha1, _ in nested], depth)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import os
+import re
+import bz2
+import lzma
+import mmap
+import zlib
+import queue
+import struct
+import threading
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+XZ_HEADER_MAGIC = b'\xfd7zXZ\x00'
+XZ_FOOTER_MAGIC = b'YZ'
+# stream header followed by the first block header magic (pi) of a bzip2 stream
+BZIP2_STREAM = re.compile(rb'BZh[1-9]1AY&SY')
+
+# consecutive gzip members / bzip2 streams are grouped into jobs of at least this many compressed bytes
+job_bytes = 4 * 1024 * 1024
+readahead_chunk = 1024 * 1024
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def decompress_pool() -> ThreadPoolExecutor:
+    """
+    shared pool for decoding blocks; zlib, bz2 and lzma release the GIL while decoding so threads scale
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            from config import decompress_workers
+            _pool = ThreadPoolExecutor(decompress_workers, thread_name_prefix='decompress')
+        return _pool
+
+
+def _read_varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def xz_blocks(buf) -> List[Tuple[int, int, int, bytes]]:
+    """
+    (offset, unpadded size, uncompressed size, stream flags) of every block of a possibly
+    multi-stream xz file, found by walking the stream footers and indices backwards
+    :raise ValueError: buf is not a well-formed xz file
+    """
+    blocks = []
+    end = len(buf)
+    while end > 0:
+        while end >= 4 and buf[end - 4:end] == b'\x00' * 4:  # stream padding
+            end -= 4
+        if end < 24:
+            raise ValueError('truncated xz stream')
+        footer = buf[end - 12:end]
+        if footer[10:12] != XZ_FOOTER_MAGIC:
+            raise ValueError('bad xz stream footer')
+        flags = footer[8:10]
+        index_start = end - 12 - (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+        index = buf[index_start:end - 12]
+        if not index or index[0] != 0:
+            raise ValueError('bad xz index')
+        count, pos = _read_varint(index, 1)
+        records = []
+        for _ in range(count):
+            unpadded, pos = _read_varint(index, pos)
+            uncompressed, pos = _read_varint(index, pos)
+            records.append((unpadded, uncompressed))
+        start = index_start - sum((unpadded + 3) & ~3 for unpadded, _ in records) - 12
+        if start < 0 or buf[start:start + 6] != XZ_HEADER_MAGIC:
+            raise ValueError('bad xz stream header')
+        offset = start + 12
+        stream_blocks = []
+        for unpadded, uncompressed in records:
+            stream_blocks.append((offset, unpadded, uncompressed, flags))
+            offset += (unpadded + 3) & ~3
+        blocks[:0] = stream_blocks
+        end = start
+    return blocks
+
+
+def decode_xz_block(buf, offset: int, unpadded: int, uncompressed: int, flags: bytes) -> bytes:
+    """
+    decode one xz block on its own by wrapping it in a single-block stream
+    """
+    header = XZ_HEADER_MAGIC + flags + struct.pack('<I', zlib.crc32(flags))
+    index = b'\x00' + _varint(1) + _varint(unpadded) + _varint(uncompressed)
+    index += b'\x00' * (-len(index) % 4)
+    index += struct.pack('<I', zlib.crc32(index))
+    backward = struct.pack('<I', len(index) // 4 - 1)
+    footer = struct.pack('<I', zlib.crc32(backward + flags)) + backward + flags + XZ_FOOTER_MAGIC
+    block = buf[offset:offset + ((unpadded + 3) & ~3)]
+    return lzma.decompress(header + block + index + footer, format=lzma.FORMAT_XZ)
+
+
+def bgzf_members(buf) -> List[Tuple[int, int]]:
+    """
+    (offset, size) of the gzip members of a BGZF file (bgzip, samtools), read from the
+    BSIZE field each member carries in its 'BC' extra subfield
+    :raise ValueError: buf is not BGZF
+    """
+    members = []
+    pos = 0
+    while pos < len(buf):
+        header = buf[pos:pos + 12]
+        if header[:3] != b'\x1f\x8b\x08' or not header[3] & 4:
+            raise ValueError('not a BGZF member')
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = buf[pos + 12:pos + 12 + xlen]
+        size = None
+        i = 0
+        while i + 4 <= len(extra):
+            slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+            if extra[i:i + 2] == b'BC' and slen == 2:
+                size = struct.unpack('<H', extra[i + 4:i + 6])[0] + 1
+            i += 4 + slen
+        if size is None:
+            raise ValueError('not a BGZF member')
+        members.append((pos, size))
+        pos += size
+    return members
+
+
+def bzip2_streams(buf) -> List[Tuple[int, int]]:
+    """
+    (offset, size) of the concatenated streams of a bzip2 file, as written by pbzip2 or lbzip2
+    """
+    offsets = [m.start() for m in BZIP2_STREAM.finditer(buf)]
+    if not offsets or offsets[0] != 0:
+        raise ValueError('not a bzip2 file')
+    return [(a, b - a) for a, b in zip(offsets, offsets[1:] + [len(buf)])]
+
+
+def group(segments: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    merge adjacent segments into jobs of at least job_bytes, so tiny BGZF members do not cost a task each
+    """
+    jobs = []
+    for offset, size in segments:
+        if jobs and jobs[-1][1] < job_bytes:
+            jobs[-1] = (jobs[-1][0], jobs[-1][1] + size)
+        else:
+            jobs.append((offset, size))
+    return jobs
+
+
+def decode_members(buf, offset: int, size: int, decompressor: Callable) -> bytes:
+    """
+    decode a run of complete gzip members or bzip2 streams
+    """
+    data = buf[offset:offset + size]
+    out = []
+    while data:
+        d = decompressor()
+        out.append(d.decompress(data))
+        if not d.eof:
+            raise OSError('compressed segment ends mid-stream')
+        data = d.unused_data
+    return b''.join(out)
+
+
+class OrderedReader(object):
+    """
+    file-like object over jobs decoded on the decompression pool, returned in job order.
+    At most `ahead` jobs are decoded ahead of the reader.
+    """
+
+    def __init__(self, buf, decode: Callable, jobs: list, ahead: int):
+        self.buf = buf
+        self.decode = decode
+        self.jobs = iter(jobs)
+        self.ahead = ahead
+        self.pending = deque()
+        self.data = b''
+        self.pos = 0
+        self.fill()
+
+    def fill(self) -> None:
+        while len(self.pending) < self.ahead:
+            job = next(self.jobs, None)
+            if job is None:
+                return
+            self.pending.append(decompress_pool().submit(self.decode, self.buf, *job))
+
+    def read(self, n: int = -1) -> bytes:
+        chunks = []
+        while n is None or n < 0 or n > 0:
+            if self.pos >= len(self.data):
+                if not self.pending:
+                    break
+                self.data, self.pos = self.pending.popleft().result(), 0
+                self.fill()
+                continue
+            end = len(self.data) if n is None or n < 0 else min(len(self.data), self.pos + n)
+            chunks.append(self.data[self.pos:end])
+            if n is not None and n >= 0:
+                n -= end - self.pos
+            self.pos = end
+        return b''.join(chunks)
+
+    def close(self) -> None:
+        """
+        drop the jobs not yet decoded and unmap the input once the running ones are done with it
+        """
+        for future in self.pending:
+            future.cancel()
+        wait(self.pending)
+        self.pending.clear()
+        self.jobs = iter(())
+        self.buf.close()
+
+
+class ReadaheadReader(object):
+    """
+    decode a stream that cannot be split on a background thread, so decompression overlaps
+    with whatever the reader does with the data (tar member writes, hashing, uploads)
+    """
+
+    def __init__(self, stream, depth: int = 16):
+        self.queue = queue.Queue(depth)
+        self.data = b''
+        self.pos = 0
+        self.done = False
+        self.closed = threading.Event()
+        threading.Thread(target=self.run, args=(stream,), name='readahead', daemon=True).start()
+
+    def run(self, stream) -> None:
+        try:
+            while not self.closed.is_set():
+                data = stream.read(readahead_chunk)
+                self.queue.put(data)
+                if not data:
+                    return
+        except Exception as e:
+            self.queue.put(e)
+
+    def read(self, n: int = -1) -> bytes:
+        chunks = []
+        while n is None or n < 0 or n > 0:
+            if self.pos >= len(self.data):
+                if self.done:
+                    break
+                data = self.queue.get()
+                if isinstance(data, Exception):
+                    raise data
+                if not data:
+                    self.done = True
+                    break
+                self.data, self.pos = data, 0
+                continue
+            end = len(self.data) if n is None or n < 0 else min(len(self.data), self.pos + n)
+            chunks.append(self.data[self.pos:end])
+            if n is not None and n >= 0:
+                n -= end - self.pos
+            self.pos = end
+        return b''.join(chunks)
+
+    def close(self) -> None:
+        """
+        stop the read-ahead thread; a chunk it is blocked on putting gets the room it needs
+        """
+        self.closed.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+
+def large_input(fin) -> bool:
+    from config import parallel_decompress_min
+    try:
+        return os.fstat(fin.fileno()).st_size >= parallel_decompress_min
+    except (AttributeError, OSError, ValueError):
+        return False
+
+
+def parallel_stream(fin, compression: str) -> Optional[OrderedReader]:
+    """
+    decompressed contents of a large gzip, bzip2 or xz file decoded on the decompression pool:
+    xz blocks (xz -T), BGZF members and concatenated bzip2 streams (pbzip2) are independent
+    and decode in parallel.
+    :return: None if fin is small or has no independent blocks; decode it sequentially instead
+    """
+    from config import decompress_workers
+    if compression not in ('gzip', 'bzip2', 'xz') or decompress_workers < 2 or not large_input(fin):
+        return None
+    buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if compression == 'xz':
+            decode, jobs = decode_xz_block, xz_blocks(buf)
+        elif compression == 'gzip':
+            decode, jobs = decode_members, [_ + (lambda: zlib.decompressobj(31),) for _ in group(bgzf_members(buf))]
+        else:
+            decode, jobs = decode_members, [_ + (bz2.BZ2Decompressor,) for _ in group(bzip2_streams(buf))]
+    except (ValueError, IndexError, struct.error):
+        jobs = []
+    if len(jobs) < 2:
+        buf.close()
+        return None
+    logger.debug('decoding %s in %d parallel jobs' % (compression, len(jobs)))
+    return OrderedReader(buf, decode, jobs, decompress_workers + 1)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Set, Tuple
+import transfer
+
+logger = logging.getLogger(__name__)
+
+# SQS SendMessageBatch and SNS PublishBatch both take at most 10 entries
+max_batch = 10
+
+_stop = object()
+
+
+class PublishError(Exception):
+    pass
+
+
+def sqs_sender(queue_url: str, region_name: str) -> Callable[[List[Tuple[str, str]]], Set[str]]:
+    def send(entries: List[Tuple[str, str]]) -> Set[str]:
+        response = transfer.client('sqs', region_name=region_name).send_message_batch(
+            QueueUrl=queue_url, Entries=[{'Id': i, 'MessageBody': body} for i, body in entries])
+        return {_['Id'] for _ in response.get('Failed', [])}
+    return send
+
+
+def sns_sender(topic_arn: str, region_name: str) -> Callable[[List[Tuple[str, str]]], Set[str]]:
+    def send(entries: List[Tuple[str, str]]) -> Set[str]:
+        response = transfer.client('sns', region_name=region_name).publish_batch(
+            TopicArn=topic_arn, PublishBatchRequestEntries=[{'Id': i, 'Message': body} for i, body in entries])
+        return {_['Id'] for _ in response.get('Failed', [])}
+    return send
+
+
+class BatchPublisher(object):
+    """
+    buffers messages and sends them in batches of up to 10 from a background thread.
+    A batch goes out when it is full or flush_interval seconds after its first message.
+    Only the entries reported as failed are retried; everything left is flushed on close().
+    publish() returns a Future resolved once the message is sent, or failed with PublishError
+    once it is given up.
+    :param send: callable taking [(id, body)] and returning the set of ids that failed
+    """
+
+    def __init__(self, send: Callable[[List[Tuple[str, str]]], Set[str]], flush_interval: float = 0.5,
+                 max_retries: int = 5, max_pending: int = 10000):
+        self.send = send
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.queue = queue.Queue(max_pending)
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='BatchPublisher', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def publish(self, body: str) -> Future:
+        assert not self.closed
+        sent = Future()
+        self.queue.put((body, 0, sent))
+        return sent
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(_stop)
+        self.thread.join()
+
+    def run(self) -> None:
+        pending = []
+        deadline = None
+        stopping = False
+        while pending or not stopping:
+            if not stopping:
+                timeout = None if deadline is None else max(0.0, deadline - time.time())
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+                if item is _stop:
+                    stopping = True
+                elif item is not None:
+                    pending.append(item)
+                    if deadline is None:
+                        deadline = time.time() + self.flush_interval
+                    # drain whatever is already waiting without blocking
+                    while len(pending) < max_batch:
+                        try:
+                            item = self.queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if item is _stop:
+                            stopping = True
+                            break
+                        pending.append(item)
+            if not pending:
+                continue
+            if stopping or len(pending) >= max_batch or time.time() >= deadline:
+                batch, pending = pending[:max_batch], pending[max_batch:]
+                pending += self.send_batch(batch)
+                deadline = time.time() + self.flush_interval if pending else None
+
+    def send_batch(self, batch: List[Tuple[str, int, Future]]) -> List[Tuple[str, int, Future]]:
+        entries = [(str(i), body) for i, (body, _, _) in enumerate(batch)]
+        try:
+            failed = self.send(entries)
+        except Exception as e:
+            logger.warning('publish batch failed: %r' % e)
+            failed = {i for i, _ in entries}
+        retry = []
+        for i, (body, attempts, sent) in enumerate(batch):
+            if str(i) not in failed:
+                sent.set_result(None)
+            elif attempts + 1 >= self.max_retries:
+                logger.warning('give up publishing message: %s' % body)
+                sent.set_exception(PublishError('gave up after %d attempts' % self.max_retries))
+            else:
+                retry.append((body, attempts + 1, sent))
+        if retry:
+            time.sleep(0.1 * 2 ** min(_[1] for _ in retry))
+        return retry
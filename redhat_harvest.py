@@ -5,114 +5,150 @@ import os
 from os.path import join
 import sys
 from urllib.parse import urlsplit
-import pdb
+import ftplib
+import logging
+import threading
 import traceback
-import ftputil
-from ftputil import FTPHost
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
 from retrying import retry
 from boto3x import upload_file
+from ftp_pool import download, ftp_pool
+from ftp_listing import ListingCache, list_dir, walk
+from host_governor import HostUnavailable
+
+logger = logging.getLogger(__name__)
 
 
 dl_dir = 'downloads'
+_listing_cache = None
+_listing_cache_lock = threading.Lock()
+
+
+def listing_cache() -> ListingCache:
+    """
+    the FTP listing cache, opened on first use rather than when the module is imported
+    """
+    global _listing_cache
+    with _listing_cache_lock:
+        if _listing_cache is None:
+            from config import ftp_listing_db
+            _listing_cache = ListingCache(ftp_listing_db)
+        return _listing_cache
 
 
 def retry_if_ftp_error(ex):
-    return isinstance(ex, (ftputil.error.FTPOSError, ConnectionResetError))
+    # an open circuit is already a pause of its own; retrying it at once only spins
+    if isinstance(ex, HostUnavailable):
+        return False
+    return isinstance(ex, (ftplib.error_temp, ConnectionError, TimeoutError, EOFError))
 
 
-@retry(retry_on_exception=retry_if_ftp_error)
-def download_file(ftp_url):
-    hostname = urlsplit(ftp_url).hostname
+def download_file(ftp_url) -> Optional[Tuple[str, Optional[str]]]:
+    """
+    download ftp_url into dl_dir over the shared FTP connection pool
+    :return: (local file path, Last-Modified), None if the download failed
+    """
     local_f = join(dl_dir, os.path.basename(urlsplit(ftp_url).path))
-    with FTPHost(hostname, 'anonymous', 'john@gmail.com', timeout=20) as host:
-        for attempt in range(100): # pylint: disable=unused-variable
-            try:
-                host.download(urlsplit(ftp_url).path, local_f)
-                return
-            except OSError:
-                host = FTPHost(hostname, 'anonymous', 'john@gmail.com', timeout=20) # noqa
-            except Exception as ex:
-                pdb.set_trace()
-                print(ex)
-                traceback.print_exc()
-                try:
-                    os.remove(local_f)
-                except:
-                    pass
-
-
-@retry(retry_on_exception=retry_if_ftp_error)
+    try:
+        last_modified = download(ftp_pool(), ftp_url, local_f)
+    except ftplib.all_errors as ex:
+        # a partial file is kept and resumed by the next run
+        logger.warning('download %s failed %s' % (ftp_url, ex))
+        return None
+    return local_f, last_modified
+
+
+def upload_rpm(ftp_url, local_f, last_modified):
+    try:
+        upload_file(ftp_url, local_f, 'application/x-rpm', last_modified)
+    except Exception as ex:
+        logger.warning('upload %s failed %s' % (local_f, ex))
+        logger.warning(traceback.format_exc())
+    finally:
+        try:
+            os.remove(local_f)
+        except OSError:
+            pass
+
+
+@retry(retry_on_exception=retry_if_ftp_error, stop_max_attempt_number=10,
+       wait_exponential_multiplier=1000, wait_exponential_max=60000)
 def crawl_ftp(repo, start=0):
     if start == 0:
-        with open('redhat_list.txt', 'w') as fout:
-            pass
         hostname = urlsplit(repo).hostname
-        with FTPHost(hostname, 'anonymous', 'john@gmail.com', timeout=20) as host: # noqa E501
-            host.keep_alive()
-            pardir = urlsplit(repo).path.split('$', 1)[0]
-            host.chdir(pardir)
-            dirs = host.listdir('.')
-            for dir in dirs: # pylint: disable=redefined-builtin
-                if not re.match(r'\d+(\.\d+)*\w*', dir):
+        pool = ftp_pool()
+        pardir = urlsplit(repo).path.split('$', 1)[0]
+        subdir = repo.split('$', 1)[1].split('/', 1)[1].strip('/')
+        roots = []
+        with pool.connection(hostname) as ftp:
+            for dir, is_dir, _ in list_dir(ftp, pardir): # pylint: disable=redefined-builtin
+                if not is_dir or not re.match(r'\d+(\.\d+)*\w*', dir):
                     continue
-                host.chdir(host.path.join(pardir, dir))
-                subdir = repo.split('$', 1)[1].split('/', 1)[1].strip('/')
-                try:
-                    host.chdir(subdir)
-                except ftputil.error.PermanentError:
-                    subdir = subdir.rsplit('/', 1)[0]
+                for candidate in (subdir, subdir.rsplit('/', 1)[0]):
                     try:
-                        host.chdir(subdir)
-                    except ftputil.error.PermanentError as ex:
-                        pdb.set_trace()
-                        traceback.print_exc()
-
-                print('collect rpm files from ', host.getcwd())
-                collected = 0
-                with open('redhat_list.txt', 'a') as fout:
-                    for root, dirs, files in host.walk(host.getcwd()):
-                        for f in files:
-                            if f.endswith('.rpm'):
-                                remo_url = 'ftp://' + hostname + join(root, f)
-                                fout.write(remo_url + '\n')
-                                collected += 1
-                print('Done. collected=%d' % collected)
+                        ftp.cwd(join(pardir, dir, candidate))
+                    except ftplib.error_perm:
+                        continue
+                    roots.append(join(pardir, dir, candidate))
+                    break
+                else:
+                    logger.warning('no %s under %s' % (subdir, join(pardir, dir)))
+
+        print('collect rpm files from %d directories' % len(roots))
+        collected = 0
+        with open('redhat_list.txt', 'w') as fout:
+            for root, f in walk(pool, hostname, roots, listing_cache()):
+                if f.endswith('.rpm'):
+                    remo_url = 'ftp://' + hostname + join(root, f)
+                    fout.write(remo_url + '\n')
+                    collected += 1
+        print('Done. collected=%d' % collected)
 
+    from config import ftp_connections
     file_downed = 0
-    with open('redhat_list.txt', 'r') as fin:
-        for line in fin:
-            ftp_url = line.strip()
-            if not ftp_url:
-                continue
-            file_downed += 1
-            if file_downed < start:
-                continue
-            print('%d, download' % file_downed, ftp_url)
-            try:
-                download_file(ftp_url)
-            except Exception as ex:
-                pdb.set_trace()
-                print(ex)
-                traceback.print_exc()
-            local_f = join(dl_dir, os.path.basename(urlsplit(ftp_url).path)) # noqa
-            print('%d, upload' % file_downed, local_f)
+    # downloads keep every pooled connection busy while finished files upload alongside;
+    # inflight bounds the files downloaded but not yet uploaded
+    inflight = threading.BoundedSemaphore(ftp_connections * 2)
+    with ThreadPoolExecutor(ftp_connections, thread_name_prefix='upload') as uploads, \
+            ThreadPoolExecutor(ftp_connections, thread_name_prefix='ftp') as downloads:
+        def fetch(n, ftp_url):
             try:
-                upload_file(local_f)
-            except Exception as ex:
-                pdb.set_trace()
-                print(ex)
-                traceback.print_exc()
+                print('%d, download' % n, ftp_url)
+                result = download_file(ftp_url)
+                if result is None:
+                    inflight.release()
+                    return
+                local_f, last_modified = result
+                print('%d, upload' % n, local_f)
+                uploads.submit(upload_rpm, ftp_url, local_f, last_modified).add_done_callback(
+                    lambda _: inflight.release())
+            except BaseException:
+                inflight.release()
+                raise
+
+        with open('redhat_list.txt', 'r') as fin:
+            for line in fin:
+                ftp_url = line.strip()
+                if not ftp_url:
+                    continue
+                file_downed += 1
+                if file_downed < start:
+                    continue
+                inflight.acquire()
+                downloads.submit(fetch, file_downed, ftp_url)
 
     with open('redhat_list.txt', 'r') as fin:
         all_files = sum(1 for line in fin)
     if file_downed != all_files:
-        print('early loop break down. all_files=%d, file_downed=%d' %
-              (all_files, file_downed))
-        pdb.set_trace()
+        logger.warning('early loop break down. all_files=%d, file_downed=%d' %
+                       (all_files, file_downed))
     print('file_downed=', file_downed)
 
 
 def main():
+    logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s %(message)s",
+                        stream=sys.stdout, level=logging.INFO)
     startRepo = 0
     startFile = 0
     if len(sys.argv) > 2:
@@ -137,6 +173,7 @@ def main():
         print('[%d]repo=%s' % (irepo, repo))
         crawl_ftp(repo, startFile)
         startFile = 0
+    ftp_pool().close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import time
+import random
+import sqlite3
+import threading
+import logging
+from typing import Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RepoSchedule(object):
+    """
+    persistent refresh schedule per repository. Each repository keeps its own interval:
+    halved when a refresh finds new files, grown by half when it finds none, within
+    [min_interval, max_interval], so an active update repository is refreshed often and
+    a frozen vault repository rarely.
+    """
+
+    def __init__(self, path: str, min_interval: float, max_interval: float, initial_interval: float):
+        self.path = path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.initial_interval = initial_interval
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS repo_schedule ('
+                ' repo TEXT PRIMARY KEY,'
+                ' interval REAL,'
+                ' next_run REAL,'
+                ' last_change REAL,'
+                ' refreshes INTEGER,'
+                ' changes INTEGER)')
+
+    def add(self, repo: str) -> None:
+        """
+        schedule repo for a refresh now, unless it is known already
+        """
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO repo_schedule VALUES (?, ?, 0, NULL, 0, 0)',
+                              (repo, self.initial_interval))
+
+    def due(self, now: Optional[float] = None) -> List[str]:
+        """
+        repositories whose next refresh is due, longest overdue first
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            rows = self.conn.execute('SELECT repo FROM repo_schedule WHERE next_run<=? ORDER BY next_run',
+                                     (now,)).fetchall()
+        return [_[0] for _ in rows]
+
+    def next_run(self, repos: Iterable[str]) -> Optional[float]:
+        """
+        earliest next refresh among repos
+        """
+        repos = list(repos)
+        with self.lock:
+            row = self.conn.execute('SELECT MIN(next_run) FROM repo_schedule WHERE repo IN (%s)'
+                                    % ','.join('?' * len(repos)), repos).fetchone()
+        return row[0]
+
+    def record(self, repo: str, changes: int, now: Optional[float] = None) -> float:
+        """
+        adapt repo's interval to the outcome of the refresh that just finished
+        :param changes: number of new files the refresh found
+        :return: the new interval in seconds
+        """
+        now = time.time() if now is None else now
+        with self.lock, self.conn:
+            row = self.conn.execute('SELECT interval, last_change FROM repo_schedule WHERE repo=?',
+                                    (repo,)).fetchone()
+            interval, last_change = row if row else (self.initial_interval, None)
+            if changes:
+                interval, last_change = max(self.min_interval, interval / 2), now
+            else:
+                interval = min(self.max_interval, interval * 1.5)
+            # jitter so repositories added together do not stay in lockstep
+            next_run = now + interval * random.uniform(0.9, 1.1)
+            self.conn.execute(
+                'UPDATE repo_schedule SET interval=?, next_run=?, last_change=?,'
+                ' refreshes=refreshes+1, changes=changes+? WHERE repo=?',
+                (interval, next_run, last_change, changes, repo))
+        return interval
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import os
+import re
+import json
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import Callable, Optional
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from host_governor import HostUnavailable, host_governor, host_of
+
+logger = logging.getLogger(__name__)
+
+chunk_size = 1024 * 1024
+# errors while a response body is read: the bytes so far are kept and the rest is requested again
+TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                    urllib3.exceptions.HTTPError, OSError)
+
+
+class DownloadError(Exception):
+    pass
+
+
+class IncompleteDownload(OSError):
+    pass
+
+
+class RangeIgnored(Exception):
+    pass
+
+
+class PartialFile(object):
+    """
+    a download in progress: the bytes received so far in <local_f>.part, and in
+    <local_f>.part.json the url and the validators (etag, last_modified, size) of the
+    file they came from. The bytes are only resumed from while the validators still match.
+    A segmented download preallocates the whole file and records the [start, end) ranges
+    already written in segments; it is None for a file written front to back.
+    """
+
+    def __init__(self, local_f: str, url: str):
+        self.local_f = local_f
+        self.url = url
+        self.path = local_f + '.part'
+        self.meta_path = self.path + '.json'
+        self.validators = {}
+        self.segments = None
+        self.lock = threading.Lock()
+        try:
+            with open(self.meta_path) as fin:
+                meta = json.load(fin)
+        except (OSError, ValueError):
+            meta = None
+        if meta and meta.get('url') == url and os.path.exists(self.path):
+            self.validators = meta['validators']
+            self.segments = meta.get('segments')
+        else:
+            self.discard()
+
+    @property
+    def offset(self) -> int:
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def matches(self, validators: dict) -> bool:
+        """
+        True if the partial bytes belong to the file described by validators. A file with
+        neither an ETag nor a Last-Modified cannot be told apart from a new one, so it never matches.
+        """
+        if not (self.validators.get('etag') or self.validators.get('last_modified')):
+            return False
+        return same_file(self.validators, validators)
+
+    def resumable(self, validators: dict) -> bool:
+        """
+        True if the transfer can go on from the end of the partial file
+        """
+        return self.segments is None and self.offset > 0 and self.matches(validators)
+
+    def start(self, validators: dict, segmented: bool = False) -> None:
+        """
+        drop the partial bytes and record the validators of a transfer from byte zero;
+        a segmented transfer gets a file of the full size up front
+        """
+        self.validators = validators
+        self.segments = [] if segmented else None
+        with open(self.path, 'wb') as fout:
+            if segmented:
+                try:
+                    os.posix_fallocate(fout.fileno(), 0, validators['size'])
+                except (AttributeError, OSError):
+                    fout.truncate(validators['size'])
+        self.save()
+
+    def segment_done(self, start: int, end: int) -> None:
+        with self.lock:
+            self.segments.append([start, end])
+            self.save()
+
+    def save(self) -> None:
+        meta = {'url': self.url, 'validators': self.validators}
+        if self.segments is not None:
+            meta['segments'] = self.segments
+        tmp = self.meta_path + '.tmp'
+        with open(tmp, 'w') as fout:
+            json.dump(meta, fout)
+        os.replace(tmp, self.meta_path)
+
+    def open(self):
+        return open(self.path, 'ab')
+
+    def finish(self) -> None:
+        os.replace(self.path, self.local_f)
+        self.remove(self.meta_path)
+
+    def discard(self) -> None:
+        self.validators = {}
+        self.segments = None
+        self.remove(self.path)
+        self.remove(self.meta_path)
+
+    @staticmethod
+    def remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def http_validators(r: requests.Response) -> dict:
+    """
+    ETag, Last-Modified and full size of the file r is (part of)
+    """
+    size = None
+    if r.status_code == 206:
+        m = re.match(r'bytes \d+-\d+/(\d+)', r.headers.get('Content-Range', ''))
+        size = int(m.group(1)) if m else None
+    elif r.headers.get('Content-Length') and not r.headers.get('Content-Encoding'):
+        size = int(r.headers['Content-Length'])
+    return {'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified'), 'size': size}
+
+
+def range_start(r: requests.Response) -> Optional[int]:
+    m = re.match(r'bytes (\d+)-', r.headers.get('Content-Range', ''))
+    return int(m.group(1)) if m else None
+
+
+def if_range(validators: dict) -> Optional[str]:
+    # a weak ETag is not allowed in If-Range
+    etag = validators.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return validators.get('last_modified')
+
+
+def segmentable(r: requests.Response, validators: dict) -> bool:
+    from config import segmented_min, download_segments
+    return download_segments > 1 and validators['size'] is not None and validators['size'] >= segmented_min \
+        and if_range(validators) is not None and r.headers.get('Accept-Ranges') != 'none'
+
+
+def same_file(expected: dict, validators: dict) -> bool:
+    return all(validators.get(k) == v for k, v in expected.items() if v is not None)
+
+
+def new_session(connections: int) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def read_range(session: requests.Session, f_url: str, validators: dict, start: int, end: int,
+               stop: threading.Event, retries: int, timeout: int, verify: bool,
+               write: Callable[[int, bytes], None]) -> int:
+    """
+    pass bytes [start, end) of the file described by validators to write(offset, chunk) as
+    they arrive, resuming within the range after a broken transfer
+    :return: offset reached, end unless stop was set
+    :raise RangeIgnored: the server answered with the whole file, or the file changed
+    """
+    validator = if_range(validators)
+    pos = start
+    failures = 0
+    while pos < end:
+        if stop.is_set():
+            return pos
+        begin = pos
+        try:
+            with host_governor().request(host_of(f_url), TRANSIENT_ERRORS) as call:
+                r = session.get(f_url, stream=True, timeout=timeout, verify=verify,
+                                headers={'Range': 'bytes=%d-%d' % (pos, end - 1), 'If-Range': validator})
+                call.response(r.status_code, r.headers.get('Retry-After'))
+                try:
+                    if r.status_code == 200:
+                        raise RangeIgnored(f_url)
+                    if r.status_code >= 500 or r.status_code == 429:
+                        raise IncompleteDownload('%d %s' % (r.status_code, r.reason))
+                    if r.status_code != 206:
+                        raise DownloadError('%s %d %s' % (f_url, r.status_code, r.reason))
+                    if range_start(r) != pos or not same_file(validators, http_validators(r)):
+                        raise RangeIgnored('%s answered %s' % (f_url, r.headers.get('Content-Range')))
+                    while pos < end and not stop.is_set():
+                        chunk = r.raw.read(min(chunk_size, end - pos))
+                        if not chunk:
+                            raise IncompleteDownload('%d of %d bytes' % (pos - start, end - start))
+                        write(pos, chunk)
+                        pos += len(chunk)
+                finally:
+                    r.close()
+        except HostUnavailable:
+            raise
+        except TRANSIENT_ERRORS as e:
+            failures = 0 if pos > begin else failures + 1
+            if failures >= retries:
+                raise DownloadError('%s range %d-%d failed %d times: %s' % (f_url, start, end, failures, e))
+            logger.info('retry %s at %d: %s' % (f_url, pos, e))
+            time.sleep(min(2 ** failures, 30))
+    return pos
+
+
+def fetch_range(session: requests.Session, f_url: str, partial: PartialFile, start: int, end: int,
+                stop: threading.Event, retries: int, timeout: int, verify: bool) -> None:
+    """
+    write bytes [start, end) of f_url into the partial file at their offset
+    :raise RangeIgnored: the server answered with the whole file, or the file changed
+    """
+    fd = os.open(partial.path, os.O_WRONLY)
+    try:
+        pos = read_range(session, f_url, partial.validators, start, end, stop, retries, timeout, verify,
+                         lambda offset, chunk: os.pwrite(fd, chunk, offset))
+    finally:
+        os.close(fd)
+    if pos == end:
+        partial.segment_done(start, end)
+
+
+def segmented_download(f_url: str, partial: PartialFile, retries: Optional[int] = None,
+                       timeout: int = 60, verify: bool = True) -> bool:
+    """
+    fetch the file partial was started for as config.segment_bytes ranges, config.download_segments
+    at a time over pooled connections, into the preallocated partial file. Ranges recorded as
+    written by an earlier attempt are skipped.
+    :return: False if the server does not honour Range; the partial file is then of no use
+    :raise DownloadError: a range failed retries times in a row
+    """
+    from config import download_retries, download_segments, segment_bytes
+    retries = retries or download_retries
+    size = partial.validators['size']
+    done = {start for start, _ in partial.segments}
+    ranges = [(start, min(start + segment_bytes, size)) for start in range(0, size, segment_bytes)
+              if start not in done]
+    logger.info('download %s in %d ranges of %d bytes' % (f_url, len(ranges), segment_bytes))
+    stop = threading.Event()
+    with new_session(download_segments) as session:
+        with ThreadPoolExecutor(download_segments, thread_name_prefix='range') as executor:
+            futures = [executor.submit(fetch_range, session, f_url, partial, start, end, stop, retries, timeout, verify)
+                       for start, end in ranges]
+            wait(futures, return_when=FIRST_EXCEPTION)
+            stop.set()
+        for future in futures:
+            if future.exception() is not None:
+                if isinstance(future.exception(), RangeIgnored):
+                    return False
+                raise future.exception()
+    return True
+
+
+class RangeReader(object):
+    """
+    file-like reader of a large file fetched as config.segment_bytes ranges, config.download_segments
+    at a time, and handed out in order without a local copy. Only the ranges not yet read are
+    held in memory.
+    """
+
+    def __init__(self, f_url: str, validators: dict, retries: Optional[int] = None,
+                 timeout: int = 60, verify: bool = True):
+        from config import download_retries, download_segments, segment_bytes
+        self.f_url = f_url
+        self.validators = validators
+        self.size = validators['size']
+        self.segment_bytes = segment_bytes
+        self.retries = retries or download_retries
+        self.timeout = timeout
+        self.verify = verify
+        self.pos = 0
+        self.buffer = memoryview(b'')
+        self.stop = threading.Event()
+        self.session = new_session(download_segments)
+        self.executor = ThreadPoolExecutor(download_segments, thread_name_prefix='range')
+        self.starts = iter(range(0, self.size, segment_bytes))
+        self.pending = deque()
+        for _ in range(download_segments):
+            self.fetch_next()
+        logger.info('download %s in ranges of %d bytes' % (f_url, segment_bytes))
+
+    def fetch_next(self) -> None:
+        start = next(self.starts, None)
+        if start is not None:
+            self.pending.append(self.executor.submit(self.fetch, start, min(start + self.segment_bytes, self.size)))
+
+    def fetch(self, start: int, end: int) -> bytearray:
+        buf = bytearray(end - start)
+
+        def write(offset: int, chunk: bytes) -> None:
+            buf[offset - start:offset - start + len(chunk)] = chunk
+        read_range(self.session, self.f_url, self.validators, start, end, self.stop,
+                   self.retries, self.timeout, self.verify, write)
+        return buf
+
+    def read(self, n: int = -1) -> bytes:
+        """
+        :raise RangeIgnored: the server does not honour Range; nothing was read yet
+        :raise DownloadError: a range failed, or the file changed while it was read
+        """
+        if n is None or n < 0:
+            n = self.size
+        if not self.buffer and self.pending:
+            try:
+                self.buffer = memoryview(self.pending.popleft().result())
+            except RangeIgnored as e:
+                if self.pos == 0:
+                    raise
+                raise DownloadError('%s changed while it was read: %s' % (self.f_url, e))
+            self.fetch_next()
+        data = self.buffer[:n].tobytes()
+        self.buffer = self.buffer[n:]
+        self.pos += len(data)
+        return data
+
+    def close(self) -> None:
+        self.stop.set()
+        self.starts = iter(())
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def __enter__(self) -> 'RangeReader':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.close()
+        return False
+
+
+def http_download(f_url: str, local_f: str, response: Optional[requests.Response] = None,
+                  retries: Optional[int] = None, timeout: int = 60, verify: bool = True):
+    """
+    download f_url to local_f, resuming with Range/If-Range after a broken transfer, and
+    after a crash from the partial file left by an earlier run. Only attempts that made no
+    progress count against retries. A file of config.segmented_min bytes or more is fetched
+    as parallel byte ranges, or as a single stream if the server does not honour Range.
+    :param response: an open streamed response for f_url to start from
+    :return: headers of the last response
+    :raise DownloadError: the server refused the file, retries attempts in a row failed, or
+    the host is down
+    """
+    from config import download_retries
+    retries = retries or download_retries
+    host = host_of(f_url)
+    partial = PartialFile(local_f, f_url)
+    failures = 0
+    segmented = True
+    while True:
+        offset = partial.offset
+        r = response
+        response = None
+        try:
+            with host_governor().request(host, TRANSIENT_ERRORS) as call:
+                if r is not None and r.status_code == 200 and partial.resumable(http_validators(r)):
+                    logger.info('resume %s at %d' % (f_url, offset))
+                    r.close()
+                    r = None
+                if r is None:
+                    headers = {}
+                    if partial.resumable(partial.validators) and if_range(partial.validators):
+                        headers = {'Range': 'bytes=%d-' % offset, 'If-Range': if_range(partial.validators)}
+                    r = requests.get(f_url, stream=True, timeout=timeout, verify=verify, headers=headers)
+                    call.response(r.status_code, r.headers.get('Retry-After'))
+                if r.status_code == 416:
+                    partial.discard()
+                    raise IncompleteDownload('range not satisfiable')
+                if r.status_code >= 500 or r.status_code == 429:
+                    raise IncompleteDownload('%d %s' % (r.status_code, r.reason))
+                if r.status_code not in (200, 206):
+                    raise DownloadError('%s %d %s' % (f_url, r.status_code, r.reason))
+                validators = http_validators(r)
+                if r.status_code == 206 and (range_start(r) != offset or not partial.resumable(validators)):
+                    partial.discard()
+                    raise IncompleteDownload('unexpected range %s' % r.headers.get('Content-Range'))
+                if not (r.status_code == 200 and segmented and segmentable(r, validators)):
+                    if r.status_code == 200:
+                        # new file, or the server ignored Range / If-Range did not match
+                        partial.start(validators)
+                    with partial.open() as fout:
+                        while True:
+                            chunk = r.raw.read(chunk_size)
+                            if not chunk:
+                                break
+                            fout.write(chunk)
+                    size = partial.validators.get('size')
+                    if size is not None and partial.offset != size:
+                        raise IncompleteDownload('%d of %d bytes' % (partial.offset, size))
+                    partial.finish()
+                    return r.headers
+                r.close()
+            # the ranges take slots of their own, so this request's slot is given back first
+            if partial.segments is None or not partial.matches(validators):
+                partial.start(validators, segmented=True)
+            if segmented_download(f_url, partial, timeout=timeout, verify=verify):
+                partial.finish()
+                return r.headers
+            logger.info('%s ignores Range, download as a single stream' % f_url)
+            segmented = False
+            partial.discard()
+        except HostUnavailable as e:
+            raise DownloadError('%s: %s' % (f_url, e))
+        except TRANSIENT_ERRORS as e:
+            failures = 0 if partial.offset > offset else failures + 1
+            if failures >= retries:
+                raise DownloadError('%s failed %d times: %s' % (f_url, failures, e))
+            logger.info('retry %s at %d: %s' % (f_url, partial.offset, e))
+            time.sleep(min(2 ** failures, 30))
+        finally:
+            if r is not None:
+                r.close()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import struct
+import logging
+from typing import BinaryIO, Dict, Iterator, Tuple
+
+logger = logging.getLogger(__name__)
+
+RPM_MAGIC = b'\xed\xab\xee\xdb'
+HEADER_MAGIC = b'\x8e\xad\xe8\x01'
+LEAD_SIZE = 96
+
+RPMTAG_PAYLOADFORMAT = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+RPM_STRING_TYPE = 6
+
+CPIO_NEWC_MAGIC = (b'070701', b'070702')
+CPIO_HEADER_SIZE = 110
+CPIO_TRAILER = 'TRAILER!!!'
+S_IFMT = 0o170000
+S_IFREG = 0o100000
+
+
+class RpmError(Exception):
+    pass
+
+
+def _read_exact(stream, n: int) -> bytes:
+    data = b''
+    while len(data) < n:
+        chunk = stream.read(n - len(data))
+        if not chunk:
+            raise RpmError('unexpected end of RPM')
+        data += chunk
+    return data
+
+
+def read_header(stream) -> Tuple[Dict[int, str], int]:
+    """
+    read one header structure and return its string tags plus the number of bytes consumed
+    """
+    intro = _read_exact(stream, 16)
+    if intro[:4] != HEADER_MAGIC:
+        raise RpmError('bad header magic')
+    nindex, hsize = struct.unpack('>II', intro[8:16])
+    index = _read_exact(stream, nindex * 16)
+    store = _read_exact(stream, hsize)
+    tags = {}
+    for i in range(nindex):
+        tag, typ, offset, _ = struct.unpack('>IIII', index[i * 16:i * 16 + 16])
+        if typ == RPM_STRING_TYPE:
+            end = store.find(b'\x00', offset)
+            tags[tag] = store[offset:end].decode('utf-8', 'replace')
+    return tags, 16 + nindex * 16 + hsize
+
+
+def open_payload(stream) -> Tuple[str, str]:
+    """
+    skip lead, signature and header of an RPM read from stream.
+    :return: (payload format, payload compressor) from the header tags;
+             stream is left at the first byte of the compressed payload
+    """
+    lead = _read_exact(stream, LEAD_SIZE)
+    if lead[:4] != RPM_MAGIC:
+        raise RpmError('not an RPM')
+    _, consumed = read_header(stream)
+    # the signature header is padded to a multiple of 8 bytes
+    if consumed % 8:
+        _read_exact(stream, 8 - consumed % 8)
+    tags, _ = read_header(stream)
+    return tags.get(RPMTAG_PAYLOADFORMAT, 'cpio'), tags.get(RPMTAG_PAYLOADCOMPRESSOR, 'gzip')
+
+
+class _CpioFile(object):
+    def __init__(self, stream, size: int):
+        self.stream = stream
+        self.remain = size
+
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0 or n > self.remain:
+            n = self.remain
+        if n == 0:
+            return b''
+        data = self.stream.read(n)
+        self.remain -= len(data)
+        return data
+
+    def skip(self) -> None:
+        while self.read(1024 * 1024):
+            pass
+
+
+def iter_cpio(stream) -> Iterator[Tuple[str, BinaryIO, int, int]]:
+    """
+    (name, file object, size, mtime) of every regular file of a newc/crc cpio stream.
+    Hard links carry their data on the last link only, the empty links are skipped.
+    """
+    pos = 0
+    while True:
+        header = _read_exact(stream, CPIO_HEADER_SIZE)
+        pos += CPIO_HEADER_SIZE
+        if header[:6] not in CPIO_NEWC_MAGIC:
+            raise RpmError('unsupported cpio format %r' % header[:6])
+        fields = [int(header[6 + i * 8:14 + i * 8], 16) for i in range(13)]
+        mode, nlink, mtime, filesize, namesize = fields[1], fields[4], fields[5], fields[6], fields[11]
+        name = _read_exact(stream, namesize)[:-1].decode('utf-8', 'surrogateescape')
+        pos += namesize
+        if pos % 4:
+            _read_exact(stream, 4 - pos % 4)
+            pos += 4 - pos % 4
+        if name == CPIO_TRAILER:
+            return
+        member = _CpioFile(stream, filesize)
+        if mode & S_IFMT == S_IFREG and (filesize or nlink <= 1):
+            yield name, member, filesize, mtime
+        member.skip()
+        pos += filesize
+        if pos % 4:
+            _read_exact(stream, 4 - pos % 4)
+            pos += 4 - pos % 4
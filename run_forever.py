@@ -1,15 +1,98 @@
+#!/usr/bin/env python3
+# coding: utf-8
 import os
 import sys
 import time
+import asyncio
+import logging
+import traceback
+from typing import List, Set
+import fim_harvester
+from download_queue import download_queue
+from repo_schedule import RepoSchedule
 
+logger = logging.getLogger(__name__)
 
-def main():
+csv_files = ['fim_linux_repository.csv', 'list of repositories.csv']
+# the CSV files are re-read this often for added or removed repositories
+reload_interval = 600
+
+
+async def refresh(root: str, templates: List[str], schedule: RepoSchedule, slots: asyncio.Semaphore,
+                  running: Set[str], finished: asyncio.Event) -> None:
+    try:
+        async with slots:
+            logger.info('refresh %s (%d templates)' % (root, len(templates)))
+            try:
+                changes = await fim_harvester.harvest_root(root, templates)
+            except Exception as e:
+                logger.warning('refresh %s failed %r' % (root, e))
+                logger.warning(traceback.format_exc())
+                changes = 0
+            interval = schedule.record(root, changes)
+            logger.info('%s: %d new files, next refresh in %d s' % (root, changes, interval))
+    finally:
+        running.discard(root)
+        finished.set()
+
+
+async def serve() -> None:
+    """
+    refresh the repositories of the CSV files on adaptive schedules, in this one process so
+    clients, connection pools and caches stay warm between refreshes. Templates sharing a
+    crawl root are scheduled and crawled together; a root is never refreshed twice at once.
+    """
+    from config import schedule_db, refresh_min_interval, refresh_max_interval, \
+        refresh_initial_interval, refresh_concurrency
+    os.makedirs(fim_harvester.dl_dir, exist_ok=True)
+    fim_harvester.downloads = download_queue(fim_harvester.download_file)
+    schedule = RepoSchedule(schedule_db, refresh_min_interval, refresh_max_interval, refresh_initial_interval)
+    slots = asyncio.Semaphore(refresh_concurrency)
+    finished = asyncio.Event()
+    running = set()
+    tasks = set()  # the event loop only keeps weak references to tasks
+    roots = {}  # crawl root -> templates
+    reloaded = 0
     while True:
-        my_dir = os.path.dirname(__file__)
-        os.system('%s %s' % (sys.executable, os.path.join(my_dir, 'fim_harvester.py')))
-        time.sleep(600)
+        now = time.time()
+        if now - reloaded >= reload_interval:
+            templates = []
+            for csv_file in csv_files:
+                templates += fim_harvester.read_templates(csv_file)
+            roots = fim_harvester.group_templates(templates)
+            for root in roots:
+                schedule.add(root)
+            reloaded = now
+        for root in schedule.due(now):
+            if root in roots and root not in running:
+                running.add(root)
+                task = asyncio.ensure_future(refresh(root, roots[root], schedule, slots, running, finished))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        wake = min(reloaded + reload_interval, schedule.next_run(set(roots) - running) or float('inf'))
+        finished.clear()
+        try:
+            await asyncio.wait_for(finished.wait(), max(1.0, wake - time.time()))
+        except asyncio.TimeoutError:
+            pass
+
+
+def main():
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s %(message)s",
+                        stream=sys.stdout, level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if fim_harvester.downloads is not None:
+            fim_harvester.downloads.close()
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
 
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import struct
+import hashlib
+import threading
+import zipfile
+import logging
+from collections import OrderedDict, namedtuple
+from typing import Optional
+from extract import is_tar_header
+from rpm_reader import RPM_MAGIC
+
+logger = logging.getLogger(__name__)
+
+# kind is the unpack_archive handler key, '' when no handler applies;
+# desc follows libmagic's wording so callers matching on it keep working
+FileType = namedtuple('FileType', ['kind', 'desc'])
+
+# deep enough for the ISO 9660 volume descriptor at 32769
+header_size = 32 * 1024 + 8
+cache_size = 100000
+
+# (kind, magic, offset, desc)
+SIGNATURES = [
+    ('xz', b'\xfd7zXZ\x00', 0, 'XZ compressed data'),
+    ('lzip', b'LZIP', 0, 'lzip compressed data'),
+    ('lzop', b'\x89LZO\x00\r\n\x1a\n', 0, 'lzop compressed data'),
+    ('rzip', b'RZIP', 0, 'rzip compressed data'),
+    ('arj', b'\x60\xea', 0, 'ARJ archive data'),
+    ('squashfs', b'hsqs', 0, 'Squashfs filesystem, little endian'),
+    ('squashfs', b'sqsh', 0, 'Squashfs filesystem, big endian'),
+    ('iso', b'CD001', 32769, 'ISO 9660 CD-ROM filesystem data'),
+]
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def gzip_name(head: bytes) -> str:
+    """
+    original file name stored in a gzip header (FNAME), '' if there is none
+    """
+    flags = head[3]
+    if not flags & 8:
+        return ''
+    pos = 10
+    if flags & 4:
+        pos += 2 + struct.unpack('<H', head[10:12])[0]
+    end = head.find(b'\x00', pos)
+    if end < 0:
+        return ''
+    return head[pos:end].decode('latin-1')
+
+
+def sniff_header(head: bytes, path: Optional[str]) -> Optional[FileType]:
+    """
+    recognize our archive formats from the first header_size bytes of path;
+    None if the header matches none of them. Without a path a jar is only told
+    from a zip by a manifest within the header.
+    """
+    if head.startswith(RPM_MAGIC):
+        return FileType('rpm', 'RPM v%d.%d %s' % (head[4], head[5], 'src' if head[7] == 1 else 'bin'))
+    if head.startswith(b'!<arch>\n'):
+        if head[8:21] == b'debian-binary':
+            return FileType('deb', 'Debian binary package')
+        return FileType('', 'current ar archive')
+    if head.startswith(b'\x1f\x8b'):
+        name = gzip_name(head)
+        if not name:
+            return FileType('gzip', 'gzip compressed data')
+        return FileType('iso.gz' if name.endswith('.iso') else 'gzip', 'gzip compressed data, was "%s"' % name)
+    if head.startswith(b'BZh') and head[3:4].isdigit():
+        return FileType('bzip2', 'bzip2 compressed data, block size = %s00k' % head[3:4].decode())
+    if head.startswith(b'\x5d\x00\x00'):
+        if head[5:13] == b'\xff' * 8:
+            return FileType('lzma', 'LZMA compressed data, streamed')
+        if len(head) < 13:
+            return None
+        return FileType('', 'LZMA compressed data, non-streamed, size %d' % struct.unpack('<q', head[5:13])[0])
+    if head.startswith(b'PK\x03\x04'):
+        if b'META-INF/MANIFEST.MF' in head:
+            return FileType('jar', 'Jar file')
+        if path is None:
+            return FileType('zip', 'Zip archive data')
+        try:
+            with zipfile.ZipFile(path) as zf:
+                if 'META-INF/MANIFEST.MF' in zf.namelist():
+                    return FileType('jar', 'Jar file')
+        except zipfile.BadZipFile:
+            pass
+        return FileType('zip', 'Zip archive data')
+    if is_tar_header(head[:512]):
+        return FileType('tar', 'POSIX tar archive')
+    for kind, magic, offset, desc in SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            return FileType(kind, desc)
+    return None
+
+
+def libmagic(head: bytes, path: str) -> FileType:
+    import magic
+    desc = magic.from_file(path)
+    if desc == 'data' and len(head) >= 1000 and \
+            (head.startswith(b'#!/bin/bash') or head.startswith(b'#!/bin/sh')):
+        desc = 'self-extracting installer'
+    return FileType('', desc)
+
+
+def sniff(path: str) -> FileType:
+    """
+    file type of path from one header read. Headers none of our signatures match go to
+    libmagic, memoized by the sha1 of the header and the file size.
+    """
+    with open(path, 'rb') as fin:
+        head = fin.read(header_size)
+        fin.seek(0, 2)
+        size = fin.tell()
+    ftype = sniff_header(head, path)
+    if ftype is not None:
+        return ftype
+    key = (hashlib.sha1(head).digest(), size)
+    with _cache_lock:
+        ftype = _cache.get(key)
+        if ftype is not None:
+            _cache.move_to_end(key)
+            return ftype
+    ftype = libmagic(head, path)
+    with _cache_lock:
+        _cache[key] = ftype
+        if len(_cache) > cache_size:
+            _cache.popitem(last=False)
+    return ftype
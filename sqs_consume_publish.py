@@ -7,14 +7,24 @@ import sys
 import json
 import logging
 import traceback
+from typing import Callable, Optional, Set, Tuple
 import shutil
+import tempfile
 import subprocess
 from pprint import pformat
-import boto3
+import transfer
 from botocore.exceptions import ClientError
 import humanfriendly
 from tqdm import tqdm
-from unpack_archive import NotSupportedFileType, unpack_archive, chown_to_me
+from unpack_archive import NotSupportedFileType, chown_to_me
+from nested_extract import expand_nested, nested_header, unpack_nested
+from extract import EXTRACT_ERRORS, PrefixedReader, iter_members, streamable, write_member
+from sniff import header_size
+from hashing import forget_hashes, hash_file
+from upload_stage import UploadStage
+from sqs_consumer import SqsBatchConsumer
+from journal import StepJournal
+from config import stream_children
 
 logger = logging.getLogger(__name__)
 
@@ -24,57 +34,71 @@ ext_dir = 'extracted'
 
 
 def getSha256(fname: str) -> str:
-    import hashlib
-    sha256 = hashlib.sha256()
-    with open(fname, 'rb') as f:
-        while True:
-            data = f.read(1024 * 1024)
-            if not data:
-                break
-            sha256.update(data)
-    return sha256.hexdigest()
+    return hash_file(fname).sha256
 
 
-def guen_keyname(key: str) -> str:
-    return key[:2] + '/' + key[2:5] + '/' + key[5:8] + '/' + key
+def upload_members(bucket: str, arcname: str, callback, skip: Optional[Set[str]] = None,
+                   on_uploaded: Optional[Callable[[str, str], None]] = None) -> Tuple[int, int]:
+    """
+    hash and upload every member of arcname straight out of the archive.
+    Each member is spooled in memory up to child_spool_bytes (only larger ones touch the disk)
+    while its sha256 is computed, then uploaded to its _extracted/ key in the background.
+    A member that may itself be an archive is written under dl_dir instead, so expand_nested()
+    can unpack it and its members are uploaded as '<member>!/<path>', as unpack_nested() does.
+    Members in skip, already uploaded by an interrupted run, are passed over.
+    :return: number of uploaded and failed children
+    :raise EXTRACT_ERRORS: arcname is corrupt; the uploads already submitted are waited for
+    """
+    from config import child_spool_bytes
+    stage = UploadStage(bucket, callback, on_uploaded=on_uploaded)
+    with tempfile.TemporaryDirectory(dir=dl_dir) as workdir:
+        def nested_candidates():
+            for relpath, fileobj, _ in iter_members(arcname):
+                head = fileobj.read(header_size)
+                fileobj = PrefixedReader(head, fileobj)
+                if nested_header(head):
+                    write_member(workdir, relpath, fileobj)
+                    yield relpath, None
+                elif not (skip and relpath in skip):
+                    stage.submit_stream(relpath, fileobj, child_spool_bytes, dl_dir)
+
+        try:
+            for relpath, _ in expand_nested(nested_candidates(), workdir):
+                if not (skip and relpath in skip):
+                    stage.submit_file(pjoin(workdir, relpath), name=relpath)
+        finally:
+            # the files under workdir are uploaded before it is removed
+            uploaded, failed = stage.join()
+    forget_hashes()
+    return len(uploaded), len(failed)
 
 
 def main():
     logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s %(message)s",
                         stream=sys.stdout, level=logging.INFO)
+    from config import sqs_wait_seconds, sqs_visibility_timeout, sqs_heartbeat_interval, \
+        sqs_retry_delay, sqs_max_retry_delay
 
     os.makedirs(dl_dir, exist_ok=True)
-    sqs = boto3.client('sqs')
-    s3 = boto3.resource('s3')
-
-    try:
-        with open('.sqs_step', 'r') as fin:
-            step = fin.readline().strip()
-            if step == 'recvMsg':
-                pass
-            elif step == 'delMsg':
-                remains = fin.read()
-                response = json.loads(remains)
-            elif step == 'downloadFile':
-                remains = fin.readline()
-                bucket, key = [_.strip() for _ in remains.split(' ', maxsplit=1)]
-            elif step == 'unpack_archive':
-                local_file = fin.readline().strip()
-                bucket = fin.readline().strip()
-            elif step == 'getDirSize':
-                ext_total_bytes = int(fin.readline().strip())
-                bucket = fin.readline().strip()
-            elif step == 'uploadFiles':
-                ext_total_bytes = int(fin.readline().strip())
-                bucket = fin.readline().strip()
-                children = list()
-                for l in fin:
-                    l = l.strip()
-                    if not l:
-                        continue
-                    children.append(l)
-    except FileNotFoundError:
-        step = ''
+    consumer = SqsBatchConsumer(SqsUrl, visibility_timeout=sqs_visibility_timeout,
+                                heartbeat_interval=sqs_heartbeat_interval, wait_time=sqs_wait_seconds)
+    # every stage transition and uploaded child is journaled as it happens;
+    # the message is deleted only once its children are uploaded (step 'end')
+    journal = StepJournal('.sqs_journal')
+    step, state, done = journal.load()
+    receipt_handle = state.get('receipt_handle')
+    receive_count = state.get('receive_count', 1)
+    bucket = state.get('bucket')
+    key = state.get('key')
+    local_file = state.get('local_file')
+    ext_total_bytes = state.get('ext_total_bytes')
+    children = state.get('children')
+    upload_ok = state.get('upload_ok', True)
+    release_after = state.get('release_after')
+    if step:
+        logger.info('resume at step %s, %d children already uploaded' % (step, len(done)))
+    if receipt_handle:
+        consumer.hold(receipt_handle)
 
     def hook(t: tqdm):
         def inner(bytes_amount):
@@ -84,77 +108,104 @@ def main():
     while True:
         try:
             if step in ['', 'end', 'recvMsg']:
+                if receipt_handle:
+                    if upload_ok:
+                        logger.debug("Delete Message: %s" % receipt_handle)
+                        consumer.ack(receipt_handle)
+                    else:
+                        consumer.release(receipt_handle, release_after)
+                    receipt_handle = None
+                    upload_ok = True
+                    release_after = None
+                if step != 'recvMsg':
+                    journal.reset()
+                    done = set()
                 step = 'recvMsg'
-                logger.info("sqs.receive_message " + SqsUrl)
-                response = sqs.receive_message(QueueUrl=SqsUrl)
-                response_code = response['ResponseMetadata']['HTTPStatusCode']
-                logger.debug('response_code = %s' % response_code)
-                try:
-                    message_body = response['Messages'][0]['Body']
-                except (KeyError, IndexError):
-                    logger.info("MessageBody not exist  %s" % pformat(response))
+                message = consumer.receive()
+                if not message:
                     continue
+                receipt_handle = message['ReceiptHandle']
+                receive_count = int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+                message_body = message['Body']
 
-            if step in ['recvMsg', 'delMsg']:
-                if step == 'delMsg':
-                    assert response
-                step = 'delMsg'
-                receipt_handle = response['Messages'][0]['ReceiptHandle']
-                logger.debug("Delete Message: %s" % receipt_handle)
-                try:
-                    sqs.delete_message(QueueUrl=SqsUrl, ReceiptHandle=receipt_handle)
-                except ClientError as e:
-                    logger.warning("delete_message error: %s" % pformat(e))
-
-            if step in ['delMsg', 'downloadFile']:
+            if step in ['recvMsg', 'downloadFile']:
                 if step == 'downloadFile':
                     assert bucket
                     assert key
-                elif step == 'delMsg':
+                elif step == 'recvMsg':
                     bucket = json.loads(message_body)['bucket']
                     key = json.loads(message_body)['key']
                 step = 'downloadFile'
+                journal.stage(step, receipt_handle=receipt_handle, receive_count=receive_count, bucket=bucket, key=key)
                 logger.debug('key=' + key)
                 local_file = pjoin(dl_dir, key.split('/')[-1])
                 try:
-                    s3_obj = s3.Bucket(bucket).Object(key)
-                    fileSize = s3_obj.content_length
+                    fileSize = transfer.client('s3').head_object(Bucket=bucket, Key=key)['ContentLength']
                     logger.info('download size=%s s3://%s/%s' % (humanfriendly.format_size(fileSize), bucket, key))
                     with tqdm(total=fileSize, ncols=100, leave=False) as t:
-                        s3_obj.download_file(local_file, Callback=hook(t))
+                        transfer.download_file(bucket, key, local_file, size=fileSize, Callback=hook(t))
                 except ClientError as e:
                     if e.response['Error']['Code'] == "404":
                         logger.warning('Bucket Key Not exist: ' + key)
                     else:
+                        # S3 failed, not the message: keep it and let it come back later, backing
+                        # off so a lasting error (e.g. AccessDenied) does not spin
                         logger.warning('Key "%s" exception %s' % (key, pformat(e.response)))
+                        upload_ok = False
+                        release_after = min(sqs_max_retry_delay, sqs_retry_delay * 2 ** min(receive_count - 1, 16))
+                        step = 'end'
+                        journal.stage(step, upload_ok=upload_ok, release_after=release_after)
+                        continue
 
             if not os.path.exists(local_file):
                 logger.info('File download error ' + local_file)
                 step = 'end'
                 continue
+            if step in ['downloadFile', 'streamChildren'] and stream_children and streamable(local_file):
+                step = 'streamChildren'
+                journal.stage(step, local_file=local_file)
+                try:
+                    with tqdm(unit='B', unit_scale=True, desc='upload', ncols=100, leave=False) as t:
+                        uploaded, failed = upload_members(bucket, local_file, hook(t), skip=done,
+                                                          on_uploaded=journal.child_done)
+                except EXTRACT_ERRORS as e:
+                    # a corrupt archive: leave it to unpack_archive, which ends it as unsupported if need be
+                    logger.warning('stream children of %s failed %r, unpack it instead' % (local_file, e))
+                    step = 'unpack_archive'
+                else:
+                    logger.info('uploaded %d children of %s' % (uploaded, local_file))
+                    upload_ok = not failed
+                    os.remove(local_file)
+                    step = 'end'
+                    journal.stage(step, upload_ok=upload_ok)
+                    continue
             if step in ['downloadFile', 'unpack_archive']:
                 if step == 'unpack_archive':
                     assert local_file
                 step = 'unpack_archive'
+                journal.stage(step, local_file=local_file)
                 try:
                     os.makedirs(ext_dir, exist_ok=True)
-                    children = [pjoin(ext_dir, f) for f, _ in unpack_archive(abspath(local_file), abspath(ext_dir))]
+                    children = [pjoin(ext_dir, f) for f, _ in unpack_nested(abspath(local_file), abspath(ext_dir))]
                 except NotSupportedFileType as e:
                     if 'ASCII text' in e.ftype or 'XML document text' in e.ftype \
                             or 'PGP signature' in e.ftype or 'JPEG image' in e.ftype \
                             or 'PNG image' in e.ftype  \
-                            or 'x86 boot sector' in e.ftype:
+                            or 'x86 boot sector' in e.ftype or 'ISO 9660' in e.ftype:
                         children = [local_file]
                     else:
                         logger.warning('NotSupportedFileType: %s' % local_file)
                         chown_to_me(ext_dir)
                         shutil.rmtree(ext_dir)
+                        forget_hashes()
                         step = 'end'
                         continue
-                os.remove(local_file)
+                if children != [local_file]:
+                    os.remove(local_file)
 
             if step in ['getDirSize', 'unpack_archive']:
                 step = 'getDirSize'
+                journal.stage(step, children=children)
                 proc = subprocess.Popen("du %s -sb" % ext_dir, shell=True, stdout=subprocess.PIPE,
                                         universal_newlines=True, bufsize=1)
                 du_str, _ = proc.communicate()
@@ -165,53 +216,40 @@ def main():
                 if step == 'uploadFiles':
                     assert children
                 step = 'uploadFiles'
+                journal.stage(step, ext_total_bytes=ext_total_bytes)
                 try:
-                    logger.info('prepared to upload %s files' % len(children))
+                    remains = [f for f in children if f not in done]
+                    logger.info('prepared to upload %s files' % len(remains))
                     with tqdm(total=ext_total_bytes, unit='B', unit_scale=True, desc='upload', ncols=100, leave=False) as t:
-                        for f in children:
-                            try:
-                                child_key = '_extracted/' + guen_keyname(getSha256(f))
-                            except FileNotFoundError:
-                                logger.info('File not found: ' + f)
-                                continue
-                            try:
-                                logger.debug('upload child "%s" to s3://%s/%s"' % (f, bucket, child_key))
-                                fileSize = os.path.getsize(f)
-                                s3.Bucket(bucket).upload_file(f, child_key, Callback=hook(t))
-                            except ClientError as e:
-                                logger.warning('Failed to upload(%s, %s) %s' % (f, child_key, pformat(e)))
+                        stage = UploadStage(bucket, hook(t), on_uploaded=journal.child_done)
+                        for f in remains:
+                            stage.submit_file(f)
+                        _, failed = stage.join()
+                    upload_ok = not failed
                 except Exception as e:
                     logger.warning(pformat(e))
                     traceback.print_exc()
+                    upload_ok = False
                 chown_to_me(ext_dir)
                 shutil.rmtree(ext_dir)
+                forget_hashes()
+                if local_file in children and os.path.exists(local_file):
+                    os.remove(local_file)
 
             step = 'end'
+            journal.stage(step, upload_ok=upload_ok)
         except (KeyboardInterrupt, Exception) as e:
             if isinstance(e, KeyboardInterrupt):
                 logger.info('broken by user')
             else:
                 logger.warning(pformat(e))
                 logger.warning(traceback.format_exc())
-            with open('.sqs_step', 'w') as fout:
-                fout.write(step + '\n')
-                if step == 'recvMsg':
-                    pass
-                elif step == 'delMsg':
-                    fout.write(json.dumps(response, indent=2))
-                elif step == 'downloadFile':
-                    fout.write("%s %s\n" % (bucket, key))
-                elif step == 'unpack_archive':
-                    fout.write(local_file + '\n')
-                    fout.write(bucket + '\n')
-                elif step == 'getDirSize':
-                    fout.write('%s\n' % ext_total_bytes)
-                    fout.write(bucket + '\n')
-                elif step == 'uploadFiles':
-                    fout.write('%s\n' % ext_total_bytes)
-                    fout.write(bucket + '\n')
-                    for f in children:
-                        fout.write(f + '\n')
+            if step == 'end':
+                if receipt_handle and upload_ok:
+                    consumer.ack(receipt_handle)
+                journal.reset()
+            journal.close()
+            consumer.close()
             return
 
 
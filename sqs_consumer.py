@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import time
+import threading
+import logging
+from collections import deque
+from pprint import pformat
+from typing import Optional
+from botocore.exceptions import ClientError
+import transfer
+
+logger = logging.getLogger(__name__)
+
+# SQS batch APIs take at most 10 entries
+max_batch = 10
+
+
+class SqsBatchConsumer(object):
+    """
+    long-polls up to 10 messages per receive_message call and hands them out one at a time.
+    The message in progress has its visibility extended by a heartbeat thread, so a long
+    unpack does not make it reappear on the queue. Once a job runs past a heartbeat, the
+    messages still buffered behind it are released to the queue for other consumers.
+    Messages are deleted in batches only after ack(), i.e. after their work is done;
+    a crash before that lets them become visible again (at-least-once processing).
+    """
+
+    def __init__(self, queue_url: str, visibility_timeout: int = 300, heartbeat_interval: int = 60,
+                 wait_time: int = 20):
+        self.queue_url = queue_url
+        self.visibility_timeout = visibility_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.wait_time = wait_time
+        self.buffer = deque()
+        self.held = set()  # in progress
+        self.started = 0.0  # when the message in progress was handed out
+        self.acked = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self.run_heartbeat, name='sqs-heartbeat', daemon=True)
+        self.heartbeat.start()
+
+    def receive(self) -> Optional[dict]:
+        """
+        next message, long-polling for a new batch when the local buffer is empty;
+        None if the queue stayed empty for wait_time seconds
+        """
+        if not self.buffer:
+            # do not sit on acknowledged messages during a long poll
+            self.flush()
+            logger.info("sqs.receive_message " + self.queue_url)
+            response = transfer.client('sqs').receive_message(
+                QueueUrl=self.queue_url, MaxNumberOfMessages=max_batch,
+                WaitTimeSeconds=self.wait_time, VisibilityTimeout=self.visibility_timeout,
+                AttributeNames=['ApproximateReceiveCount'])
+            messages = response.get('Messages', [])
+            if not messages:
+                logger.info("MessageBody not exist  %s" % pformat(response))
+                return None
+            with self.lock:
+                self.buffer.extend(messages)
+        with self.lock:
+            if not self.buffer:
+                # released by the heartbeat meanwhile
+                return None
+            message = self.buffer.popleft()
+            self.held.add(message['ReceiptHandle'])
+            self.started = time.monotonic()
+        return message
+
+    def ack(self, receipt_handle: str) -> None:
+        with self.lock:
+            self.held.discard(receipt_handle)
+            self.acked.append(receipt_handle)
+            full = len(self.acked) >= max_batch
+        if full:
+            self.flush()
+
+    def hold(self, receipt_handle: str) -> None:
+        """
+        keep extending a message not received by this consumer, e.g. one resumed from a journal
+        """
+        with self.lock:
+            self.held.add(receipt_handle)
+            self.started = time.monotonic()
+
+    def release(self, receipt_handle: str, visibility_timeout: Optional[int] = None) -> None:
+        """
+        give up on a message: it becomes visible again once its visibility timeout runs out,
+        or after visibility_timeout seconds if given (0: at once)
+        """
+        with self.lock:
+            self.held.discard(receipt_handle)
+        if visibility_timeout is not None:
+            try:
+                transfer.client('sqs').change_message_visibility(QueueUrl=self.queue_url, ReceiptHandle=receipt_handle,
+                                                                 VisibilityTimeout=visibility_timeout)
+            except ClientError as e:
+                logger.warning("change_message_visibility error: %s" % pformat(e))
+
+    def flush(self) -> None:
+        with self.lock:
+            acked, self.acked = self.acked, []
+        for i in range(0, len(acked), max_batch):
+            entries = [{'Id': str(j), 'ReceiptHandle': h} for j, h in enumerate(acked[i:i + max_batch])]
+            try:
+                response = transfer.client('sqs').delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+                for failed in response.get('Failed', []):
+                    logger.warning("delete_message error: %s" % pformat(failed))
+            except ClientError as e:
+                logger.warning("delete_message error: %s" % pformat(e))
+
+    def change_visibility(self, receipt_handles: list, visibility_timeout: int) -> None:
+        for i in range(0, len(receipt_handles), max_batch):
+            entries = [{'Id': str(j), 'ReceiptHandle': h, 'VisibilityTimeout': visibility_timeout}
+                       for j, h in enumerate(receipt_handles[i:i + max_batch])]
+            try:
+                response = transfer.client('sqs').change_message_visibility_batch(
+                    QueueUrl=self.queue_url, Entries=entries)
+                for failed in response.get('Failed', []):
+                    logger.warning("change_message_visibility error: %s" % pformat(failed))
+            except ClientError as e:
+                logger.warning("change_message_visibility error: %s" % pformat(e))
+
+    def run_heartbeat(self) -> None:
+        while not self.stopped.wait(self.heartbeat_interval):
+            with self.lock:
+                held = list(self.held)
+                buffered = []
+                if held and time.monotonic() - self.started >= self.heartbeat_interval:
+                    # a long job: do not keep the messages queued behind it from other consumers
+                    buffered = [_['ReceiptHandle'] for _ in self.buffer]
+                    self.buffer.clear()
+            if buffered:
+                logger.info('release %d buffered messages behind a long job' % len(buffered))
+                self.change_visibility(buffered, 0)
+            self.change_visibility(held, self.visibility_timeout)
+
+    def close(self) -> None:
+        """
+        delete acknowledged messages, release the buffered ones at once and stop extending
+        the one in progress, which then returns to the queue
+        """
+        self.stopped.set()
+        self.heartbeat.join()
+        self.flush()
+        with self.lock:
+            self.held.clear()
+            buffered = [_['ReceiptHandle'] for _ in self.buffer]
+            self.buffer.clear()
+        self.change_visibility(buffered, 0)
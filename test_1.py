@@ -10,10 +10,8 @@ import traceback
 from pprint import pformat
 import humanfriendly
 from tqdm import tqdm
-import boto3
-from botocore.exceptions import ClientError
 from unpack_archive import unpack_archive, chown_to_me, NotSupportedFileType
-from sqs_consume_publish import getSha256, guen_keyname
+from upload_stage import UploadStage
 
 
 dl_dir = 'downloads'
@@ -24,7 +22,6 @@ logger = logging.getLogger(__name__)
 
 
 def main():
-    s3 = boto3.resource('s3')
     logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s %(message)s",
                         stream=sys.stdout, level=logging.INFO)
 
@@ -59,14 +56,10 @@ def main():
             try:
                 logger.info('prepared to upload %s files' % len(children))
                 with tqdm(total=ext_total_bytes, unit='B', unit_scale=True, desc='upload', ncols=100, leave=False) as t:
+                    stage = UploadStage(bucket, hook(t))
                     for f in children:
-                        child_key = '_extracted/' + guen_keyname(getSha256(f))
-                        try:
-                            logger.debug('upload child "%s" to s3://%s/%s"' % (f, bucket, child_key))
-                            fileSize = os.path.getsize(f)
-                            s3.Bucket(bucket).upload_file(f, child_key, Callback=hook(t))
-                        except ClientError as e:
-                            logger.warning('Failed to upload(%s, %s) %s' % (f, child_key, pformat(e)))
+                        stage.submit_file(f)
+                    stage.join()
             except Exception as e:
                 logger.warning(pformat(e))
                 traceback.print_exc()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import os
+import threading
+import logging
+from typing import Callable, Optional
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# single PUT below this size, multipart above
+multipart_threshold = 16 * MB
+# S3 allows at most 10000 parts per upload
+max_parts = 10000
+
+_local = threading.local()
+
+
+def _max_pool_connections() -> int:
+    from config import s3_max_pool_connections
+    return s3_max_pool_connections
+
+
+def session() -> boto3.session.Session:
+    """
+    boto3 sessions and resources are not thread-safe, so each thread gets its own,
+    created once and reused for the life of the thread.
+    see: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/resources.html#multithreading-multiprocessing
+    """
+    sess = getattr(_local, 'session', None)
+    if sess is None:
+        sess = _local.session = boto3.session.Session()
+        _local.clients = {}
+        _local.resources = {}
+    return sess
+
+
+def client(service: str, region_name: Optional[str] = None):
+    sess = session()
+    key = (service, region_name)
+    cli = _local.clients.get(key)
+    if cli is None:
+        cli = _local.clients[key] = sess.client(
+            service, region_name=region_name,
+            config=Config(max_pool_connections=_max_pool_connections()))
+    return cli
+
+
+def resource(service: str, region_name: Optional[str] = None):
+    sess = session()
+    key = (service, region_name)
+    res = _local.resources.get(key)
+    if res is None:
+        res = _local.resources[key] = sess.resource(
+            service, region_name=region_name,
+            config=Config(max_pool_connections=_max_pool_connections()))
+    return res
+
+
+def transfer_config(size: Optional[int]) -> TransferConfig:
+    """
+    small objects go up in one PUT on the calling thread, no transfer thread pool is spun up;
+    large objects use chunks big enough to stay under the part limit, with more concurrency
+    the bigger the file is.
+    """
+    if size is not None and size < multipart_threshold:
+        return TransferConfig(multipart_threshold=multipart_threshold, use_threads=False)
+    if size is None:
+        return TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_threshold)
+    chunksize = max(multipart_threshold, -(-size // max_parts))
+    chunksize = -(-chunksize // MB) * MB
+    concurrency = 4 if size < 1024 * MB else 10
+    return TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=chunksize,
+                          max_concurrency=concurrency)
+
+
+def upload_file(local_f: str, bucketName: str, key: str, size: Optional[int] = None,
+                Callback: Optional[Callable[[int], None]] = None, region_name: Optional[str] = None) -> None:
+    if size is None:
+        size = os.path.getsize(local_f)
+    client('s3', region_name).upload_file(local_f, bucketName, key, Callback=Callback,
+                                          Config=transfer_config(size))
+
+
+def upload_fileobj(fileobj, bucketName: str, key: str, size: Optional[int] = None,
+                   Callback: Optional[Callable[[int], None]] = None, region_name: Optional[str] = None) -> None:
+    client('s3', region_name).upload_fileobj(fileobj, bucketName, key, Callback=Callback,
+                                             Config=transfer_config(size))
+
+
+def download_file(bucketName: str, key: str, local_f: str, size: Optional[int] = None,
+                  Callback: Optional[Callable[[int], None]] = None, region_name: Optional[str] = None) -> None:
+    client('s3', region_name).download_file(bucketName, key, local_f, Callback=Callback,
+                                            Config=transfer_config(size))
@@ -1,6 +1,6 @@
 import os
 import shutil
-import re
+import types
 import logging
 import traceback
 import zipfile
@@ -8,6 +8,9 @@ import tempfile
 import subprocess
 from subprocess import DEVNULL
 from os.path import basename, splitext, join as pjoin, islink, isdir, abspath
+from extract import EXTRACT_ERRORS, UnsupportedMember, extract, extract_zip
+from hashing import hash_file, hash_files
+from sniff import sniff
 
 logger = logging.getLogger(__name__)
 
@@ -18,32 +21,11 @@ class NotSupportedFileType(Exception):
 
 
 def get_sha1(fname: str) -> str:
-    import hashlib
-    with open(fname, 'rb') as fin:
-        return hashlib.sha1(fin.read()).hexdigest()
+    return hash_file(fname).sha1
 
 
 def detect_filetype(filepath: str) -> str:
-    import magic
-    desc = magic.from_file(filepath)
-    if 'Zip' in desc:
-        try:
-            with zipfile.ZipFile(filepath) as fh:
-                if 'META-INF/MANIFEST.MF' in fh.namelist():
-                    return 'Jar file'
-                else:
-                    return desc
-        except:
-            return desc
-    elif desc == 'data':
-        with open(filepath, 'rb') as fh:
-            header = fh.read(1000)
-            if len(header) == 1000:
-                if header.startswith(b'#!/bin/bash') or \
-                        header.startswith(b'#!/bin/sh'):
-                    return 'self-extracting installer'
-        return desc
-    return desc
+    return sniff(filepath).desc
 
 
 def chown_to_me(pathdir: str):
@@ -72,6 +54,164 @@ def check_call(cmd, cwd=None):
                 stderr=DEVNULL, cwd=cwd)
 
 
+def unpack_in_process(arcname: str, outdir: str, tmpdir: str, ftype: str):
+    """
+    extract with the in-process engine; a bare compressed file is decoded once
+    and unpacked again, or copied to outdir if it is not an archive itself
+    :return: True if the children were already yielded
+    """
+    try:
+        payload = extract(arcname, outdir, tmpdir)
+    except EXTRACT_ERRORS as e:
+        logger.warning("extract '%s' failed %s" % (arcname, e))
+        raise NotSupportedFileType(ftype)
+    if payload is None:
+        return False
+    try:
+        yield from unpack_archive(payload, outdir)
+    except NotSupportedFileType:
+        shutil.move(payload, pjoin(outdir, basename(payload)))
+        return False
+    os.remove(payload)
+    return True
+
+
+def unpack_iso(arcname: str, outdir: str, tmpdir: str, ftype: str):
+    try:
+        check_call(["7z", "x", "-o" + tmpdir, abspath(arcname)])
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning("7z failed on '%s': %s" % (arcname, e))
+        raise NotSupportedFileType(ftype)
+    copy_without_symlink(tmpdir, outdir)
+
+
+def unpack_iso_gz(arcname: str, outdir: str, tmpdir: str, ftype: str):
+    payload = extract(arcname, outdir, tmpdir)
+    assert payload and 'ISO 9660 CD-ROM' in detect_filetype(payload)
+    with tempfile.TemporaryDirectory(suffix='.dir') as isodir:
+        unpack_iso(payload, outdir, isodir, detect_filetype(payload))
+    os.remove(payload)
+
+
+def unpack_lzma(arcname: str, outdir: str, tmpdir: str, ftype: str):
+    os.rename(arcname, arcname + '.lzma')
+    try:
+        subprocess.check_call(
+                "unlzma --stdout %s|cpio -idm " % abspath(arcname+'.lzma'),
+                shell=True, cwd=tmpdir)
+    except subprocess.CalledProcessError as e:
+        logger.warning("extract lzma '%s' failed %s" % (arcname+'.lzma', e))
+        logger.warning(traceback.format_exc())
+        raise NotSupportedFileType("Failed to unlzma: " + arcname)
+    os.rename(arcname + '.lzma', arcname)
+    chown_to_me(tmpdir)
+    copy_without_symlink(tmpdir, outdir)
+
+
+def unpack_arj(arcname: str, outdir: str, tmpdir: str, ftype: str):
+    if splitext(arcname)[1] != '.arj':
+        tmpfile = pjoin(tmpdir, basename(arcname)) + '.arj'
+    else:
+        tmpfile = pjoin(tmpdir, basename(arcname))
+    shutil.copy(arcname, tmpfile)
+    check_call(["arj", "x", "-y", tmpfile], tmpdir)
+    os.remove(tmpfile)
+    copy_without_symlink(tmpdir, outdir)
+
+
+def unpack_rzip(arcname: str, outdir: str, tmpdir: str, ftype: str):
+    if splitext(arcname)[1] != '.rz':
+        tmpfile = pjoin(tmpdir, basename(arcname)) + '.rz'
+    else:
+        tmpfile = pjoin(tmpdir, basename(arcname))
+    shutil.copy(arcname, tmpfile)
+    check_call(["rzip", "-d", tmpfile])
+    yield from unpack_archive(splitext(tmpfile)[0], outdir)
+    os.remove(splitext(tmpfile)[0])
+    return True
+
+
+def unpack_lzop(arcname: str, outdir: str, tmpdir: str, ftype: str):
+    check_call("lzop -dc '%(arcname)s'|tar xvf - -C '%(tmpdir)s'"
+               % locals())
+    copy_without_symlink(tmpdir, outdir)
+
+
+def unpack_lzip(arcname: str, outdir: str, tmpdir: str, ftype: str):
+    # .lz
+    if splitext(arcname)[1] != '.lz':
+        tmpfile = pjoin(tmpdir, basename(arcname)) + '.lz'
+    else:
+        tmpfile = pjoin(tmpdir, basename(arcname))
+    shutil.copy(arcname, tmpfile)
+    check_call(["tar", "--use-compress-program=lzip", "-xvf",
+                tmpfile, "-C", tmpdir])
+    os.remove(tmpfile)
+    copy_without_symlink(tmpdir, outdir)
+
+
+def unpack_zip(arcname: str, outdir: str, tmpdir: str, ftype: str):
+    try:
+        extract_zip(arcname, outdir)
+        return
+    except zipfile.BadZipFile:
+        logger.info('End-of-central-directory signature not found: %s' % arcname)
+        cmd = ["jar", "xvf", abspath(arcname)]
+    except UnsupportedMember as ex:
+        # Deflate64 or another method zipfile lacks, or encrypted members: unzip decodes
+        # the former and, given an empty password instead of prompting, skips the latter
+        logger.info('Zip file "%s" needs unzip: %s' % (arcname, ex))
+        cmd = ["unzip", "-o", "-P", "", abspath(arcname)]
+    try:
+        check_call(cmd, tmpdir)
+    except subprocess.CalledProcessError as ex:
+        # unzip exits with 1 after skipping the encrypted members; the others are extracted
+        if cmd[0] != 'unzip' or ex.returncode != 1:
+            logger.warning('Zip file "%s" decompress failed: %s' % (arcname, ex))
+    except BaseException as ex:
+        logger.warning('Zip file "%s" decompress failed: %s' % (arcname, ex))
+    copy_without_symlink(tmpdir, outdir)
+
+
+def unpack_jar(arcname: str, outdir: str, tmpdir: str, ftype: str):
+    shutil.copy(arcname, pjoin(outdir, basename(arcname) + '.jar'))
+
+
+def unpack_squashfs(arcname: str, outdir: str, tmpdir: str, ftype: str):
+    try:
+        subprocess.check_call("sudo unsquashfs %s" % abspath(arcname),
+                shell=True, cwd=tmpdir)
+    except subprocess.CalledProcessError as e:
+        logger.warning("unsquashfs failed: " + arcname)
+        logger.warning(traceback.format_exc())
+        raise NotSupportedFileType("unsquashfs failed :" + arcname)
+    chown_to_me(tmpdir)
+    copy_without_symlink(tmpdir, outdir)
+
+
+# sniff() kind -> handler(arcname, outdir, tmpdir, ftype); generator handlers
+# yield the children themselves and return True
+UNPACKERS = {
+    'iso.gz': unpack_iso_gz,
+    'iso': unpack_iso,
+    # .deb, .rpm, .tar, .tar.gz, .tar.bz2, .tar.xz, .gz, .bz2, .xz
+    'rpm': unpack_in_process,
+    'deb': unpack_in_process,
+    'bzip2': unpack_in_process,
+    'xz': unpack_in_process,
+    'gzip': unpack_in_process,
+    'tar': unpack_in_process,
+    'lzma': unpack_lzma,
+    'arj': unpack_arj,
+    'rzip': unpack_rzip,
+    'lzop': unpack_lzop,
+    'lzip': unpack_lzip,
+    'zip': unpack_zip,
+    'jar': unpack_jar,
+    'squashfs': unpack_squashfs,
+}
+
+
 def unpack_archive(arcname: str, outdir: str):
     """
     decompress Linux Archive file
@@ -80,161 +220,17 @@ def unpack_archive(arcname: str, outdir: str):
     :rtype: Iterator[:str:`str`, :class:`str`]
     """
     assert os.path.exists(outdir) and os.path.isdir(outdir)
-    ftype = detect_filetype(arcname)
+    kind, ftype = sniff(arcname)
+    unpacker = UNPACKERS.get(kind)
+    if unpacker is None:
+        raise NotSupportedFileType(ftype)
     already_yielded = False
 
     try:
         with tempfile.TemporaryDirectory(suffix=".dir") as tmpdir:
-            def gunzip_like_proc(fext: str, cmd: list):
-                if splitext(arcname)[1] != fext:
-                    tmp_file = pjoin(tmpdir, basename(arcname)) + fext
-                else:
-                    tmp_file = pjoin(tmpdir, basename(arcname))
-                shutil.copy(arcname, tmp_file)
-                check_call(cmd + [tmp_file])
-                try:
-                    yield from unpack_archive(splitext(tmp_file)[0], outdir)
-                except NotSupportedFileType:
-                    copy_without_symlink(tmpdir, outdir)
-                else:
-                    os.remove(splitext(tmp_file)[0])
-
-            if re.search(r'gzip compressed data,.+".+?\.iso"', ftype):
-                # .iso.gz
-                if splitext(arcname)[1] != '.gz':
-                    tmpfile = pjoin(tmpdir, basename(arcname)) + '.gz'
-                else:
-                    tmpfile = pjoin(tmpdir, basename(arcname))
-                shutil.copy(arcname, tmpfile)
-                check_call(['gunzip', '-f', tmpfile])
-                assert 'ISO 9660 CD-ROM' in detect_filetype(splitext(tmpfile)[0])
-                check_call("7z x -o'%s' '%s'" % (tmpdir, splitext(tmpfile)[0]))
-                os.remove(splitext(tmpfile)[0])
-                copy_without_symlink(tmpdir, outdir)
-
-            elif ftype.strip().startswith('RPM '):
-                try:
-                    subprocess.check_call("rpm2cpio %s | sudo cpio -idm" % abspath(arcname),
-                            shell=True, cwd=tmpdir, stdout=DEVNULL, stderr=DEVNULL)
-                    chown_to_me(tmpdir)
-                except subprocess.CalledProcessError as e:
-                    logger.warning("extract RPM '%s' failed %s" % (arcname, e))
-                    logger.warning(traceback.format_exc())
-                    raise NotSupportedFileType("Failed to extract RPM '%s'" % arcname)
-                copy_without_symlink(tmpdir, outdir)
-            elif 'Debian binary package' in ftype:
-                check_call(["dpkg", "-x", arcname, tmpdir])
-                copy_without_symlink(tmpdir, outdir)
-            elif 'bzip2' in ftype:
-                # could be tar.bz2 or .bz2
-                try:
-                    check_call(["tar", "xvjf", arcname, "-C", tmpdir])
-                except subprocess.CalledProcessError:
-                    # handle .bz2, not tar.bz2
-                    yield from gunzip_like_proc('.bz2', ["bzip2", "-d"])
-                else:
-                    if not os.listdir(tmpdir):
-                        yield from gunzip_like_proc('.bz2', ["bzip2", "-d"])
-                    else:
-                        copy_without_symlink(tmpdir, outdir)
-            elif 'XZ compressed' in ftype:
-                # LZMA is also recognized as XZ
-                # could be .tar.xz or .xz
-                try:
-                    check_call(["tar", "Jxvf", arcname, "-C", tmpdir])
-                except subprocess.CalledProcessError:
-                    # handle .xz , not .tar.xz
-                    yield from gunzip_like_proc('.xz', ["xz", "-d"])
-                else:
-                    if not os.listdir(tmpdir):
-                        yield from gunzip_like_proc('.xz', ["xz", "-d"])
-                    else:
-                        copy_without_symlink(tmpdir, outdir)
-            elif 'LZMA compressed data, streamed' in ftype:
-                os.rename(arcname, arcname + '.lzma')
-                try:
-                    subprocess.check_call(
-                            "unlzma --stdout %s|cpio -idm " % abspath(arcname+'.lzma'),
-                            shell=True, cwd=tmpdir)
-                except subprocess.CalledProcessError as e:
-                    logger.warning("extract lzma '%s' failed %s" % (arcname+'.lzma', e))
-                    logger.warning(traceback.format_exc())
-                    raise NotSupportedFileType("Failed to unlzma: " + arcname)
-                os.rename(arcname + '.lzma', arcname)
-                chown_to_me(tmpdir)
-                copy_without_symlink(tmpdir, outdir)
-            elif 'ARJ archive data' in ftype:
-                if splitext(arcname)[1] != '.arj':
-                    tmpfile = pjoin(tmpdir, basename(arcname)) + '.arj'
-                else:
-                    tmpfile = pjoin(tmpdir, basename(arcname))
-                shutil.copy(arcname, tmpfile)
-                check_call(["arj", "x", "-y", tmpfile], tmpdir)
-                os.remove(tmpfile)
-                copy_without_symlink(tmpdir, outdir)
-            elif 'rzip compressed' in ftype:
-                if splitext(arcname)[1] != '.rz':
-                    tmpfile = pjoin(tmpdir, basename(arcname)) + '.rz'
-                else:
-                    tmpfile = pjoin(tmpdir, basename(arcname))
-                shutil.copy(arcname, tmpfile)
-                check_call(["rzip", "-d", tmpfile])
-                yield from unpack_archive(splitext(tmpfile)[0], outdir)
-                os.remove(splitext(tmpfile)[0])
-                already_yielded = True
-            elif 'lzop compressed' in ftype:
-                check_call("lzop -dc '%(arcname)s'|tar xvf - -C '%(tmpdir)s'"
-                           % locals())
-                copy_without_symlink(tmpdir, outdir)
-            elif 'lzip compressed' in ftype:
-                # .lz
-                if splitext(arcname)[1] != '.lz':
-                    tmpfile = pjoin(tmpdir, basename(arcname)) + '.lz'
-                else:
-                    tmpfile = pjoin(tmpdir, basename(arcname))
-                shutil.copy(arcname, tmpfile)
-                check_call(["tar", "--use-compress-program=lzip", "-xvf",
-                            tmpfile, "-C", tmpdir])
-                os.remove(tmpfile)
-                copy_without_symlink(tmpdir, outdir)
-            elif 'gzip compressed data' in ftype:
-                # .gz or .z
-                try:
-                    check_call(["tar", "zxvf", arcname, "-C", tmpdir])
-                    if not os.listdir(tmpdir):
-                        yield from gunzip_like_proc('.gz', ["gunzip", "-f"])
-                    else:
-                        copy_without_symlink(tmpdir, outdir)
-                except subprocess.CalledProcessError:
-                    logger.info('single one gzip file %s ' % arcname)
-                    check_call("gzip -c -d  '%s' > '%s'" % (arcname, pjoin(outdir, basename(arcname))))
-            elif 'POSIX tar' in ftype:
-                check_call(["tar", "xvf", arcname, "-C", tmpdir])
-                copy_without_symlink(tmpdir, outdir)
-            elif 'Zip' in ftype:
-                try:
-                    check_call(["unzip", arcname, "-d", tmpdir])
-                except subprocess.CalledProcessError:
-                    logger.info('End-of-central-directory signature not found: %s' % arcname)
-                    try:
-                        check_call(["jar", "xvf", abspath(arcname)], tmpdir)
-                    except BaseException as ex:
-                        logger.warning('Zip file "%s" decompress failed: %s' % (arcname, ex))
-                copy_without_symlink(tmpdir, outdir)
-            elif 'Jar' in ftype:
-                shutil.copy(arcname, pjoin(outdir, basename(arcname) + '.jar'))
-            elif 'Squashfs filesystem' in ftype:
-                try:
-                    subprocess.check_call("sudo unsquashfs %s" % abspath(arcname),
-                            shell=True, cwd=tmpdir)
-                except subprocess.CalledProcessError as e:
-                    logger.warning("unsquashfs failed: " + arcname)
-                    logger.warning(traceback.format_exc())
-                    raise NotSupportedFileType("unsquashfs failed :" + arcname)
-                chown_to_me(tmpdir)
-                copy_without_symlink(tmpdir, outdir)
-            else:
-                raise NotSupportedFileType(ftype)
+            result = unpacker(arcname, outdir, tmpdir, ftype)
+            if isinstance(result, types.GeneratorType):
+                already_yielded = yield from result
     except PermissionError as e:
         try:
             chown_to_me(tmpdir)
@@ -246,8 +242,11 @@ def unpack_archive(arcname: str, outdir: str):
         logger.warning('failed to remove tmpdir= ' + tmpdir)
 
     if not already_yielded:
+        fpaths = []
         for root, _, files in os.walk(outdir):
             for f in files:
                 fpath = pjoin(root, f)
                 if not isdir(fpath) and not islink(fpath):
-                    yield os.path.relpath(fpath, outdir), get_sha1(fpath)
+                    fpaths.append(fpath)
+        for fpath, digests in zip(fpaths, hash_files(fpaths)):
+            yield os.path.relpath(fpath, outdir), digests.sha1
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import os
+import hashlib
+import tempfile
+import threading
+import logging
+from pprint import pformat
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+import transfer
+from boto3x import guen_keyname
+from hashing import hash_file
+
+logger = logging.getLogger(__name__)
+
+
+class ByteBudget(object):
+    """
+    counting semaphore over bytes: acquire(n) blocks while more than `limit` bytes are in flight.
+    A single item larger than the whole budget is let through once nothing else is in flight.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.inflight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, n: int) -> None:
+        with self.cond:
+            while self.inflight and self.inflight + n > self.limit:
+                self.cond.wait()
+            self.inflight += n
+
+    def try_acquire(self, n: int) -> bool:
+        with self.cond:
+            if self.inflight and self.inflight + n > self.limit:
+                return False
+            self.inflight += n
+            return True
+
+    def release(self, n: int) -> None:
+        with self.cond:
+            self.inflight -= n
+            self.cond.notify_all()
+
+
+class UploadStage(object):
+    """
+    uploads extracted children to `_extracted/<guen_keyname(sha256)>` on a worker pool.
+    At most `workers` uploads and `max_inflight_bytes` bytes are in flight; submit() blocks
+    the producer when either limit is reached. Outcome is recorded per child, and
+    on_uploaded(child, key) is called from the worker as each child completes.
+    """
+
+    def __init__(self, bucket: str, callback: Optional[Callable[[int], None]] = None,
+                 workers: Optional[int] = None, max_inflight_bytes: Optional[int] = None,
+                 on_uploaded: Optional[Callable[[str, str], None]] = None):
+        from config import upload_workers, upload_inflight_bytes
+        self.bucket = bucket
+        self.workers = workers or upload_workers
+        self.budget = ByteBudget(max_inflight_bytes or upload_inflight_bytes)
+        self.slots = threading.BoundedSemaphore(self.workers)
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix='upload')
+        self.lock = threading.Lock()
+        self.callback = callback
+        self.on_uploaded = on_uploaded
+        self.uploaded = {}  # child -> key
+        self.failed = {}  # child -> reason
+
+    def progress(self, bytes_amount: int) -> None:
+        if self.callback:
+            with self.lock:
+                self.callback(bytes_amount)
+
+    def _submit(self, child: str, size: int, fn, *args) -> None:
+        self.slots.acquire()
+        self.budget.acquire(size)
+
+        def run():
+            try:
+                key = fn(*args)
+                with self.lock:
+                    self.uploaded[child] = key
+                if self.on_uploaded:
+                    self.on_uploaded(child, key)
+            except Exception as e:
+                # S3UploadFailedError and other boto3 errors are neither ClientError nor OSError
+                logger.warning('Failed to upload %s %s' % (child, pformat(e)))
+                with self.lock:
+                    self.failed[child] = str(e)
+            finally:
+                self.budget.release(size)
+                self.slots.release()
+        self.pool.submit(run)
+
+    def _upload_file(self, f: str, size: int) -> str:
+        child_key = '_extracted/' + guen_keyname(hash_file(f).sha256)
+        logger.debug('upload child "%s" to s3://%s/%s"' % (f, self.bucket, child_key))
+        transfer.upload_file(f, self.bucket, child_key, size=size, Callback=self.progress)
+        return child_key
+
+    def _upload_spool(self, name: str, spool, size: int, child_key: str) -> str:
+        try:
+            logger.debug('upload child "%s" to s3://%s/%s"' % (name, self.bucket, child_key))
+            transfer.upload_fileobj(spool, self.bucket, child_key, size=size, Callback=self.progress)
+            return child_key
+        finally:
+            spool.close()
+
+    def submit_file(self, f: str, name: Optional[str] = None) -> None:
+        """
+        upload file f in the background, recorded as child name (f itself by default)
+        """
+        try:
+            size = os.path.getsize(f)
+        except FileNotFoundError:
+            logger.info('File not found: ' + f)
+            return
+        self._submit(name or f, size, self._upload_file, f, size)
+
+    def submit_stream(self, name: str, fileobj, spool_bytes: int, spool_dir: Optional[str] = None) -> None:
+        """
+        hash a child while spooling it (in memory up to spool_bytes), then upload it in the background
+        """
+        sha256 = hashlib.sha256()
+        spool = tempfile.SpooledTemporaryFile(max_size=spool_bytes, dir=spool_dir)
+        while True:
+            data = fileobj.read(1024 * 1024)
+            if not data:
+                break
+            sha256.update(data)
+            spool.write(data)
+        size = spool.tell()
+        spool.seek(0)
+        child_key = '_extracted/' + guen_keyname(sha256.hexdigest())
+        self._submit(name, size, self._upload_spool, name, spool, size, child_key)
+
+    def join(self) -> Tuple[Dict[str, str], Dict[str, str]]:
+        """
+        wait for every submitted child; returns (uploaded child -> key, failed child -> reason)
+        """
+        self.pool.shutdown(wait=True)
+        if self.failed:
+            logger.warning('%d children failed to upload' % len(self.failed))
+        return self.uploaded, self.failed
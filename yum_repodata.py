@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import re
+import bz2
+import gzip
+import lzma
+import logging
+from collections import namedtuple
+from urllib.parse import urljoin
+from typing import Iterator, List, Optional, Tuple
+import requests
+import lxml.etree
+from crawler import parse_listing
+
+logger = logging.getLogger(__name__)
+
+REPO_NS = '{http://linux.duke.edu/metadata/repo}'
+COMMON_NS = '{http://linux.duke.edu/metadata/common}'
+XML_BASE = '{http://www.w3.org/XML/1998/namespace}base'
+
+RepoPackage = namedtuple('RepoPackage', ['url', 'size', 'time', 'checksum_type', 'checksum'])
+
+
+def segment_regex(segment: str) -> str:
+    r = re.escape(segment)
+    r = r.replace(r'\$releasever', r'\d+(\.\d+)*')
+    r = r.replace(r'\$basearch', r'\w+')
+    return r + '$'
+
+
+def expand_repo(repo: str, timeout: int = 60) -> Iterator[str]:
+    """
+    resolve $releasever/$basearch in a repository template by listing the
+    directories at each templated level, e.g.
+    http://mirror.centos.org/centos/$releasever/os/$basearch/ ->
+    http://mirror.centos.org/centos/7.9.2009/os/x86_64/, ...
+    """
+    if '$' not in repo:
+        yield repo
+        return
+    prefix, rest = repo.split('$', 1)
+    prefix, partial = prefix.rsplit('/', 1)
+    prefix += '/'
+    segment, _, rest = ('$' + rest).partition('/')
+    segment = partial + segment
+    try:
+        r = requests.get(prefix, timeout=timeout, verify=False)
+    except requests.RequestException as e:
+        logger.info('Failed to list %s %r' % (prefix, e))
+        return
+    if r.status_code != 200:
+        return
+    regex = re.compile(segment_regex(segment))
+    for child in parse_listing(prefix, r.text):
+        if not child.endswith('/'):
+            continue
+        name = child[len(prefix):].rstrip('/')
+        if regex.match(name):
+            yield from expand_repo(child + rest, timeout)
+
+
+def primary_location(base_url: str, timeout: int = 60) -> Optional[str]:
+    """
+    URL of primary.xml(.gz|.xz|...) according to repodata/repomd.xml, None if the repo has no repodata
+    """
+    try:
+        r = requests.get(urljoin(base_url, 'repodata/repomd.xml'), timeout=timeout, verify=False)
+    except requests.RequestException as e:
+        logger.info('Failed to fetch repomd.xml of %s %r' % (base_url, e))
+        return None
+    if r.status_code != 200:
+        return None
+    try:
+        root = lxml.etree.fromstring(r.content)
+    except lxml.etree.XMLSyntaxError:
+        return None
+    for data in root.iter(REPO_NS + 'data'):
+        if data.get('type') == 'primary':
+            location = data.find(REPO_NS + 'location')
+            if location is not None:
+                return urljoin(location.get(XML_BASE) or base_url, location.get('href'))
+    return None
+
+
+def open_compressed(url: str, fileobj):
+    if url.endswith('.gz'):
+        return gzip.GzipFile(fileobj=fileobj)
+    elif url.endswith('.xz'):
+        return lzma.LZMAFile(fileobj)
+    elif url.endswith('.bz2'):
+        return bz2.BZ2File(fileobj)
+    elif url.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    return fileobj
+
+
+def iter_packages(base_url: str, primary_url: Optional[str] = None, timeout: int = 60) -> Iterator[RepoPackage]:
+    """
+    stream every package of a YUM/DNF repository out of its primary.xml.
+    The file is decompressed and parsed incrementally, package elements are
+    discarded as soon as they have been read.
+    """
+    if not primary_url:
+        primary_url = primary_location(base_url, timeout)
+    if not primary_url:
+        return
+    logger.info('read ' + primary_url)
+    with requests.get(primary_url, stream=True, timeout=timeout, verify=False) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        stream = open_compressed(primary_url, r.raw)
+        for _, elem in lxml.etree.iterparse(stream, events=('end',), tag=COMMON_NS + 'package'):
+            location = elem.find(COMMON_NS + 'location')
+            checksum = elem.find(COMMON_NS + 'checksum')
+            size = elem.find(COMMON_NS + 'size')
+            mtime = elem.find(COMMON_NS + 'time')
+            if location is not None:
+                yield RepoPackage(
+                    url=urljoin(location.get(XML_BASE) or base_url, location.get('href')),
+                    size=int(size.get('package')) if size is not None else None,
+                    time=int(mtime.get('file')) if mtime is not None else None,
+                    checksum_type=checksum.get('type') if checksum is not None else None,
+                    checksum=checksum.text if checksum is not None else None)
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
+def repodata_bases(repo: str) -> List[Tuple[str, str]]:
+    """
+    (base URL, primary.xml URL) of every concrete repository of a template which publishes repodata
+    """
+    bases = []
+    for base in expand_repo(repo):
+        primary_url = primary_location(base)
+        if primary_url:
+            bases.append((base, primary_url))
+    return bases